@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+# Cold-start latency benchmark for the flaggie script.
+#
+# Every scenario is run in a fresh interpreter, so the numbers include
+# the complete interpreter startup and import cost. The '?flag' query
+# needs a working portage installation and an existing package
+# (app-portage/flaggie by default, override via FLAGGIE_BENCH_ATOM).
+
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(topdir, 'flaggie')
+
+scenarios = (
+	('--version', ['--version']),
+	('--help', ['--help']),
+	('?flag', [os.environ.get('FLAGGIE_BENCH_ATOM', 'app-portage/flaggie'),
+		'?doc']),
+)
+
+
+def run(args, rounds):
+	times = []
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join(
+		[os.path.join(topdir, 'lib')] + env.get('PYTHONPATH', '').split(os.pathsep))
+	devnull = open(os.devnull, 'w')
+	try:
+		for i in range(rounds):
+			start = timer()
+			ret = subprocess.call([sys.executable, script] + args,
+					stdout=devnull, stderr=devnull, env=env)
+			times.append(timer() - start)
+			if ret != 0:
+				return None
+	finally:
+		devnull.close()
+	return sorted(times)
+
+
+def main(argv):
+	rounds = int(argv[1]) if len(argv) > 1 else 10
+
+	sys.stdout.write('%-12s %10s %10s %10s\n' % ('scenario', 'min', 'median', 'max'))
+	for name, args in scenarios:
+		times = run(args, rounds)
+		if times is None:
+			sys.stdout.write('%-12s %10s\n' % (name, 'failed'))
+			continue
+		sys.stdout.write('%-12s %8.1fms %8.1fms %8.1fms\n' % (name,
+			1000 * times[0], 1000 * times[len(times) // 2], 1000 * times[-1]))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
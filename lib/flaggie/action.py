@@ -3,6 +3,7 @@
 # (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
 # Released under the terms of the 2-clause BSD license.
 
+import copy
 import fnmatch
 
 
@@ -26,6 +27,10 @@ class Pattern(object):
 
 
 class BaseAction(object):
+	# whether the action can be applied to every namespace separately
+	# (in parallel)
+	parallel = False
+
 	def __init__(self, arg, key, output=None):
 		self.args = set((arg,))
 		self.ns = None
@@ -122,15 +127,25 @@ class BaseAction(object):
 			return True
 		return idx[0] < idx[1]
 
+	def restrict(self, ns):
+		""" Return a copy of the action restricted to namespace ns. """
+		a = copy.copy(self)
+		a.ns = frozenset((ns,))
+		return a
+
 
 class EffectiveEntryOp(BaseAction):
-	def grab_effective_entry(self, p, arg, f, rw=False):
+	parallel = True
+
+	@staticmethod
+	def grab_effective_entry(p, arg, f, rw=False):
 		for pe in f[p]:
-			flags = pe[arg]
-			for f in flags:
+			for fl in pe[arg]:
 				if rw:
+					# materialize only the entry being modified
+					fl = pe.own(fl)
 					pe.modified = True
-				return f
+				return fl
 		else:
 			if not rw:
 				return None
@@ -161,7 +176,14 @@ class EffectiveEntryOp(BaseAction):
 		for a in args:
 			for ns in self.ns:
 				if isinstance(a, Pattern):
-					for f in self._cache[ns].get_effective(pkg):
+					if hasattr(self._cache[ns], 'match'):
+						# indexed wildcard lookup
+						flags = self._cache[ns].match(a.pattern)
+					elif pkg is not None:
+						flags = self._cache[ns].get_effective(pkg)
+					else:
+						flags = self._cache[ns].glob
+					for f in flags:
 						if a == f:
 							out.append((ns, f))
 				else:
@@ -186,6 +208,8 @@ class DisableAction(EffectiveEntryOp):
 
 
 class ResetAction(BaseAction):
+	parallel = True
+
 	def __call__(self, pkgs, pfiles):
 		for ns in self.ns:
 			puse = pfiles[ns]
@@ -196,11 +220,39 @@ class ResetAction(BaseAction):
 
 
 class OutputAction(BaseAction):
-	def __call__(self, pkgs, pfiles):
+	# if set to a list, (pkg, ns, flags) tuples are appended to it
+	# instead of printing
+	sink = None
+
+	def _query_profile(self, pkgs, pfiles):
+		profile = self._cache.profile
+		for p in pkgs or (None,):
+			state = profile.query(p, pfiles['use'])
+			flags = {}
+			for arg in self.args:
+				if isinstance(arg, Pattern):
+					for fn in state:
+						if arg == fn:
+							flags[fn] = state[fn]
+				else:
+					flags[arg] = state.get(arg)
+			if flags:
+				yield (p, 'use', flags)
+
+	def query(self, pkgs, pfiles):
+		""" Yield (pkg, ns, flags) for every package, where flags
+			is a dict mapping flag names to their effective PackageFlag
+			(or None if the flag is not set in the files). If the caches
+			have the profile loaded, USE flags are evaluated using it
+			instead (see flaggie.profile.EffectiveFlag). """
 		for ns in self.ns:
+			if ns == 'use' and getattr(self._cache, 'profile', None):
+				for x in self._query_profile(pkgs, pfiles):
+					yield x
+				continue
+
 			puse = pfiles[ns]
 			for p in pkgs or (None,):
-				l = [p if p is not None else '<global>']
 				flags = {}
 				for pe in puse[p]:
 					for arg in self.args:
@@ -212,10 +264,22 @@ class OutputAction(BaseAction):
 						flags[arg] = None
 				if not flags:
 					continue
-				for fn in sorted(flags):
-					l.append(flags[fn].toString() if flags[fn] is not None else '?%s' % fn)
+				yield (p, ns, flags)
+
+	def __call__(self, pkgs, pfiles):
+		for p, ns, flags in self.query(pkgs, pfiles):
+			if self.sink is not None:
+				self.sink.append((p, ns, flags))
+				continue
 
-				print(' '.join(l))
+			print(self.format(p, flags))
+
+	@staticmethod
+	def format(p, flags):
+		l = [p if p is not None else '<global>']
+		for fn in sorted(flags):
+			l.append(flags[fn].toString() if flags[fn] is not None else '?%s' % fn)
+		return ' '.join(l)
 
 
 class NotAnAction(Exception):
@@ -266,7 +330,29 @@ class ActionSet(list):
 		else:
 			self.pkgs.append(item)
 
+	def _apply_ns(self, ns, pfiles):
+		view = pfiles.subset(ns)
+		for a in self:
+			if a.parallel and ns in a.ns:
+				a.restrict(ns)(self.pkgs, view)
+
 	def __call__(self, pfiles):
+		from flaggie.pipeline import check_results, run_parallel
+
 		self.sort()
+		# the package actions for different namespaces touch different
+		# files, so they can be applied in parallel; the global ones
+		# share make.conf, and the output needs to stay ordered
+		parallel = bool(self.pkgs)
+		if parallel:
+			nss = set()
+			for a in self:
+				if a.parallel:
+					nss.update(a.ns)
+			check_results(run_parallel([(ns,
+				(lambda ns=ns: self._apply_ns(ns, pfiles)))
+				for ns in sorted(nss)]))
+
 		for a in self:
-			a(self.pkgs, pfiles)
+			if not (parallel and a.parallel):
+				a(self.pkgs, pfiles)
@@ -5,10 +5,12 @@
 
 import os
 import os.path
+import threading
 
-from portage.dep import use_reduce
-from portage.util import grabdict, grabfile
-from portage.versions import best
+from flaggie.action import ParserError
+from flaggie.envindex import EnvIndex
+from flaggie.nameindex import PackageNameIndex
+from flaggie.stats import Stats, timer
 
 
 def grab_use_desc(path, prefix=''):
@@ -27,66 +29,246 @@ def grab_use_desc(path, prefix=''):
 	return flags
 
 
+def parse_license(arg):
+	""" Return a sorted list of all license names occuring in the LICENSE
+		string arg (regardless of USE conditionals and || groups). """
+	from portage.dep import use_reduce
+
+	try:
+		lic = use_reduce(arg, matchall=True, flat=True)
+	except TypeError:  # portage-2.1.8 compat
+		from portage.dep import paren_reduce
+		lic = use_reduce(paren_reduce(arg, tokenize=True),
+				matchall=True)
+
+	lic = set(lic)
+	lic.discard('||')
+	return sorted(lic)
+
+
+class AtomResolver(object):
+	""" Atom resolution shared by argument parsing, the caches
+		and the cleanup actions. Expansion of short package names,
+		the match-all lists and the best matches are memoized
+		(including invalid and ambiguous atoms), so that every atom
+		hits portage at most once. Plain atoms are matched against
+		a single match-all list for their cp. Short package names
+		are looked up in the persistent package name index, unless
+		the dbapi matches packages other than the repository ones. """
+
+	def __init__(self, dbapi, stats=None):
+		self.dbapi = dbapi
+		self.stats = stats if stats is not None else Stats()
+		if getattr(dbapi, 'repo_names', True):
+			self.names = PackageNameIndex(getattr(dbapi, 'porttrees', ()))
+		else:
+			self.names = None
+		self._expanded = {}
+		self._matches = {}
+		self._best = {}
+		self._cplists = {}
+		# portage dbapis are not thread-safe, so all the calls need
+		# to hold it (the actions can be applied in parallel)
+		self.lock = threading.RLock()
+
+	def _expand_short(self, a):
+		""" Expand a short package name using the name index. Returns
+			None if the package is not indexed (or a is not a short
+			name), to let dep_expand() handle it. """
+		from portage.dep import Atom, insert_category_into_atom
+		from portage.exception import AmbiguousPackageName, InvalidAtom
+
+		if self.names is None or '/' in a:
+			return None
+		try:
+			null = Atom(insert_category_into_atom(a, 'null'))
+		except InvalidAtom:
+			return None
+
+		pn = null.cp[len('null/'):]
+		cats = self.names.categories(pn)
+		if len(cats) == 2 and 'virtual' in cats:
+			# the same as portage's cpv_expand(): prefer the non-virtual
+			cats = [c for c in cats if c != 'virtual']
+		if len(cats) > 1:
+			raise AmbiguousPackageName(['%s/%s' % (c, pn) for c in cats])
+		elif cats:
+			return Atom(insert_category_into_atom(a, cats[0]))
+		return None
+
+	def _expand(self, a):
+		from portage.dbapi.dep_expand import dep_expand
+		from portage.dep import Atom
+		from portage.exception import AmbiguousPackageName, InvalidAtom
+
+		try:
+			atom = self._expand_short(a)
+			if atom is None:
+				atom = dep_expand(a, mydb=self.dbapi,
+						settings=self.dbapi.settings)
+			if atom.startswith('null/'):
+				raise InvalidAtom(atom)
+		except AmbiguousPackageName as e:
+			raise ParserError('ambiguous package name, matching: %s' % e)
+		except InvalidAtom as e:
+			try:
+				try:
+					atom = Atom(a, allow_wildcard=True)
+				except TypeError:
+					atom = Atom(a)
+			except InvalidAtom as e:
+				raise ParserError('invalid package atom: %s' % e)
+		return atom
+
+	def expand(self, a):
+		""" Expand a command-line package specification into an atom.
+			Raises ParserError if it is invalid or ambiguous. """
+		if a not in self._expanded:
+			start = timer()
+			with self.lock:
+				try:
+					self._expanded[a] = self._expand(a)
+				except ParserError as e:
+					self._expanded[a] = e
+			self.stats.miss('resolver.expand', timer() - start)
+		else:
+			self.stats.hit('resolver.expand')
+
+		ret = self._expanded[a]
+		if isinstance(ret, ParserError):
+			raise ret
+		return ret
+
+	def _match(self, k):
+		from portage.dep import Atom, match_from_list
+		from portage.exception import InvalidAtom
+
+		try:
+			a = Atom(k)
+		except InvalidAtom:
+			a = None
+		if a is None or a.slot or a.use or getattr(a, 'repo', None):
+			return self.dbapi.xmatch('match-all', k)
+
+		if a.cp not in self._cplists:
+			self._cplists[a.cp] = self.dbapi.xmatch('match-all', a.cp)
+		if a == a.cp:
+			return self._cplists[a.cp]
+		return match_from_list(a, self._cplists[a.cp])
+
+	def match_all(self, k):
+		""" Return a tuple of all packages matching k, or None
+			if k is an invalid or ambiguous atom. """
+		from portage.exception import AmbiguousPackageName, InvalidAtom
+
+		if k not in self._matches:
+			start = timer()
+			with self.lock:
+				try:
+					self._matches[k] = tuple(self._match(k))
+				except (InvalidAtom, AmbiguousPackageName):
+					self._matches[k] = None
+			self.stats.miss('resolver.match-all', timer() - start)
+		else:
+			self.stats.hit('resolver.match-all')
+		return self._matches[k]
+
+	def best(self, k):
+		""" Return the best package matching k, or None. """
+		from portage.versions import best
+
+		if k not in self._best:
+			pkgs = self.match_all(k)
+			self._best[k] = best(pkgs) if pkgs else None
+		return self._best[k]
+
+	def precompute(self, atoms):
+		""" Resolve best matches for all atoms in the iterable. """
+		for a in atoms:
+			self.best(a)
+
+
 class DBAPICache(object):
 	aux_key = None
+	ns = None
 
-	def __init__(self, dbapi):
+	def __init__(self, dbapi, stats=None, resolver=None):
 		if not self.aux_key:
 			raise AssertionError('DBAPICache.aux_key needs to be overriden.')
 		self.dbapi = dbapi
+		self.stats = stats if stats is not None else Stats()
+		if resolver is None:
+			resolver = AtomResolver(dbapi, stats)
+		self.resolver = resolver
 		self.cache = {}
 		self.effective_cache = {}
+		self._glob = None
+		# the global lists can be loaded in a background thread
+		self._glob_lock = threading.Lock()
 
 	@property
 	def glob(self):
-		raise AssertionError('DBAPICache.glob() needs to be overriden.')
+		with self._glob_lock:
+			if self._glob is None:
+				self._glob = self._load_glob()
+		return self._glob
+
+	def _load_glob(self):
+		raise AssertionError('DBAPICache._load_glob() needs to be overriden.')
 
 	def _aux_parse(self, arg):
 		return arg.split()
 
 	def __getitem__(self, k):
 		if k not in self.cache:
+			start = timer()
 			flags = set()
-			# get widest match possible to make sure we do not
-			# complain without a reason
-			for p in self.dbapi.xmatch('match-all', k):
-				flags.update(self._aux_parse(self.dbapi.aux_get(p,
-						(self.aux_key,))[0]))
+			with self.resolver.lock:
+				# get widest match possible to make sure we do not
+				# complain without a reason
+				for p in self.resolver.match_all(k) or ():
+					flags.update(self._aux_parse(self.dbapi.aux_get(p,
+							(self.aux_key,))[0]))
 			self.cache[k] = frozenset(flags)
+			self.stats.miss('cache.%s' % self.ns, timer() - start)
+		else:
+			self.stats.hit('cache.%s' % self.ns)
 		return self.cache[k]
 
 	def get_effective(self, k):
 		if k not in self.effective_cache:
-			pkgs = self.dbapi.xmatch('match-all', k)
-			if pkgs:
-				flags = self._aux_parse(self.dbapi.aux_get(
-					best(pkgs), (self.aux_key,))[0])
-			else:
-				flags = ()
+			start = timer()
+			with self.resolver.lock:
+				cpv = self.resolver.best(k)
+				if cpv is not None:
+					flags = self._aux_parse(self.dbapi.aux_get(
+						cpv, (self.aux_key,))[0])
+				else:
+					flags = ()
 			self.effective_cache[k] = frozenset(flags)
+			self.stats.miss('cache.%s.effective' % self.ns, timer() - start)
+		else:
+			self.stats.hit('cache.%s.effective' % self.ns)
 		return self.effective_cache[k]
 
 
 class FlagCache(DBAPICache):
 	aux_key = 'IUSE'
+	ns = 'use'
 
-	def __init__(self, dbapi):
-		DBAPICache.__init__(self, dbapi)
+	def __init__(self, dbapi, stats=None, resolver=None):
+		DBAPICache.__init__(self, dbapi, stats, resolver)
 		self.use_expand_vars = dbapi.settings.get('USE_EXPAND', '').split()
 
-	@property
-	def glob(self):
-		if None not in self.cache:
-			flags = set()
-			for r in self.dbapi.porttrees:
-				flags.update(grab_use_desc(os.path.join(r, 'profiles', 'use.desc')))
-				for k in self.use_expand_vars:
-					flags.update(grab_use_desc(
-						os.path.join(r, 'profiles', 'desc', '%s.desc' % k.lower()),
-						prefix=('%s_' % k.lower())))
-			self.cache[None] = frozenset(flags)
-
-		return self.cache[None]
+	def _load_glob(self):
+		flags = set()
+		for r in self.dbapi.porttrees:
+			flags.update(grab_use_desc(os.path.join(r, 'profiles', 'use.desc')))
+			for k in self.use_expand_vars:
+				flags.update(grab_use_desc(
+					os.path.join(r, 'profiles', 'desc', '%s.desc' % k.lower()),
+					prefix=('%s_' % k.lower())))
+		return frozenset(flags)
 
 	def _aux_parse(self, arg):
 		return (x.lstrip('+-') for x in arg.split())
@@ -94,19 +276,18 @@ class FlagCache(DBAPICache):
 
 class KeywordCache(DBAPICache):
 	aux_key = 'KEYWORDS'
+	ns = 'kw'
 
-	@property
-	def glob(self):
-		if None not in self.cache:
-			kws = set()
-			for r in self.dbapi.porttrees:
-				kws.update(grabfile(os.path.join(r, 'profiles', 'arch.list')))
-			kws.update(['~%s' % x for x in kws], ('*', '**', '~*'))
+	def _load_glob(self):
+		from portage.util import grabfile
 
-			# and the ** special keyword
-			self.cache[None] = frozenset(kws)
+		kws = set()
+		for r in self.dbapi.porttrees:
+			kws.update(grabfile(os.path.join(r, 'profiles', 'arch.list')))
+		kws.update(['~%s' % x for x in kws], ('*', '**', '~*'))
 
-		return self.cache[None]
+		# and the ** special keyword
+		return frozenset(kws)
 
 	def _aux_parse(self, arg):
 		kw = [x for x in arg.split() if not x.startswith('-')]
@@ -116,78 +297,152 @@ class KeywordCache(DBAPICache):
 
 class LicenseCache(DBAPICache):
 	aux_key = 'LICENSE'
+	ns = 'lic'
 	_groupcache = None
+	# minimal number of distinct LICENSE strings to start a process pool
+	pool_threshold = 256
+	pool_chunksize = 64
+
+	def __init__(self, dbapi, stats=None, resolver=None):
+		DBAPICache.__init__(self, dbapi, stats, resolver)
+		self._parsed = {}
 
 	@property
 	def groups(self):
+		from portage.util import grabdict
+
 		if self._groupcache is None:
-			self._groupcache = {}
+			# fill a local dict first, since the glob may be loaded
+			# in another thread
+			groups = {}
 			for r in self.dbapi.porttrees:
 				path = os.path.join(r, 'profiles', 'license_groups')
 				for k, v in grabdict(path).items():
 					k = '@%s' % k
-					if k not in self._groupcache:
-						self._groupcache[k] = set()
-					self._groupcache[k].update(v)
+					if k not in groups:
+						groups[k] = set()
+					groups[k].update(v)
+			self._groupcache = groups
 
 		return self._groupcache
 
-	@property
-	def glob(self):
-		if None not in self.cache:
-			lic = set()
-			for r in self.dbapi.porttrees:
-				try:
-					lic.update(os.listdir(os.path.join(r, 'licenses')))
-				except OSError:
-					pass
-				lic.update(self.groups)
+	def _load_glob(self):
+		lic = set()
+		for r in self.dbapi.porttrees:
+			try:
+				lic.update(os.listdir(os.path.join(r, 'licenses')))
+			except OSError:
+				pass
+			lic.update(self.groups)
 
-			lic.discard('CVS')
-			self.cache[None] = frozenset(lic)
+		lic.discard('CVS')
+		return frozenset(lic)
 
-		return self.cache[None]
+	def _expand_groups(self, lic):
+		lic = set(lic)
+		lic.update(k for k, v in self.groups.items() if lic & v)
+		return frozenset(lic)
 
 	def _aux_parse(self, arg):
-		try:
-			lic = use_reduce(arg, matchall=True, flat=True)
-		except TypeError:  # portage-2.1.8 compat
-			from portage.dep import paren_reduce
-			lic = use_reduce(paren_reduce(arg, tokenize=True),
-					matchall=True)
+		# the same LICENSE strings are shared by many packages
+		if arg not in self._parsed:
+			self._parsed[arg] = self._expand_groups(parse_license(arg))
+		return self._parsed[arg]
+
+	def parse_bulk(self, strings, jobs=None):
+		""" Parse all the LICENSE strings in the iterable, and store
+			the results for _aux_parse(). The distinct strings are parsed
+			in a process pool if there are enough of them, and jobs
+			is not 1. """
+		strings = sorted(set(x for x in strings if x not in self._parsed))
+		if len(strings) >= self.pool_threshold and jobs != 1:
+			import multiprocessing
+
+			pool = multiprocessing.Pool(jobs)
+			try:
+				results = pool.map(parse_license, strings,
+						chunksize=self.pool_chunksize)
+			finally:
+				pool.close()
+				pool.join()
+			for x, lic in zip(strings, results):
+				self._parsed[x] = self._expand_groups(lic)
+
+	def prefetch(self, atoms, jobs=None):
+		""" Fill the cache for all atoms in the iterable, parsing
+			the LICENSE strings via parse_bulk(). """
+		start = timer()
+		todo = {}
+		for k in atoms:
+			if k not in self.cache and k not in todo:
+				todo[k] = [self.dbapi.aux_get(p, (self.aux_key,))[0]
+						for p in self.resolver.match_all(k) or ()]
+
+		self.parse_bulk((x for v in todo.values() for x in v), jobs)
+		for k, v in todo.items():
+			flags = set()
+			for x in v:
+				flags.update(self._aux_parse(x))
+			self.cache[k] = frozenset(flags)
+		self.stats.call('cache.lic.prefetch', timer() - start)
 
-		lic = set(lic)
-		lic.discard('||')
-		lic.update(k for k, v in self.groups.items() if lic & v)
-		return lic
+
+def env_dir():
+	return os.path.join(os.environ.get('PORTAGE_CONFIGROOT', '/'),
+			'etc', 'portage', 'env')
 
 
 class EnvCache(object):
+	""" The env files are the same for all packages, so this is just
+		a wrapper around the (lazy) EnvIndex. """
+
 	def __init__(self, dbapi):
-		out = set()
-		path = os.path.join(os.environ.get('PORTAGE_CONFIGROOT', '/'),
-				'etc', 'portage', 'env')
-		for parent, dirs, files in os.walk(path):
-			out.update(os.path.relpath(os.path.join(parent, x), path) for x in files)
-		self.cache = frozenset(out)
+		self.index = EnvIndex(env_dir())
 
 	@property
 	def glob(self):
 		return frozenset()
 
 	def __getitem__(self, k):
-		return self.cache
+		return self.index
+
+	def get_effective(self, k):
+		return self.index
+
+	def match(self, pattern):
+		return self.index.match(pattern)
 
 
 class Caches(object):
-	def __init__(self, dbapi):
+	def __init__(self, dbapi, stats=None, snapshot=None):
+		if stats is None:
+			stats = Stats()
+		self.stats = stats
+		self.resolver = AtomResolver(dbapi, stats)
+		# flaggie.profile.EffectiveUse, if loaded
+		self.profile = None
 		self.caches = {
-			'use': FlagCache(dbapi),
-			'kw': KeywordCache(dbapi),
-			'lic': LicenseCache(dbapi),
+			'use': FlagCache(dbapi, stats, self.resolver),
+			'kw': KeywordCache(dbapi, stats, self.resolver),
+			'lic': LicenseCache(dbapi, stats, self.resolver),
 			'env': EnvCache(dbapi)
 		}
 
+		if snapshot is not None:
+			from flaggie.snapshot import NAMESPACES, SnapshotCache
+			for k in NAMESPACES:
+				self.caches[k] = SnapshotCache(snapshot, k, self.caches[k])
+
+	def warm(self):
+		""" Start loading the global flag lists in the background.
+			Returns the Task. """
+		from flaggie.pipeline import Task
+		return Task(self._warm)
+
+	def _warm(self):
+		for k in ('use', 'kw', 'lic'):
+			self.caches[k].glob
+
 	def glob_whatis(self, arg, restrict=None):
 		if not restrict:
 			restrict = frozenset(self.caches)
@@ -198,12 +453,20 @@ class Caches(object):
 		return ret
 
 	def whatis(self, arg, pkg, restrict=None):
+		""" Return the namespaces arg is valid in for pkg. Checking
+			env requires loading the env index, so unless it was
+			requested explicitly, it is checked only if no other
+			namespace matches. """
+		explicit = bool(restrict)
 		if not restrict:
 			restrict = frozenset(self.caches)
 		ret = set()
 		for k in self.caches:
-			if k in restrict and arg in self.caches[k][pkg]:
+			if k != 'env' and k in restrict and arg in self.caches[k][pkg]:
 				ret.add(k)
+		if ('env' in restrict and (explicit or not ret)
+				and arg in self.caches['env'][pkg]):
+			ret.add('env')
 		return ret
 
 	def describe(self, ns):
@@ -3,8 +3,6 @@
 # (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
 # Released under the terms of the 2-clause BSD license.
 
-from portage.exception import AmbiguousPackageName, InvalidAtom
-
 from flaggie.action import BaseAction
 
 
@@ -50,18 +48,15 @@ class DropUnmatchedFlags(BaseCleanupAction):
 		if pkgs:
 			raise AssertionError('pkgs not empty in cleanup action')
 
-		dbcache = {}
+		res = self._cache.resolver
+		res.precompute(pe.package for f in pfiles for pe in f)
+		# LICENSE parsing is expensive, so do it in bulk
+		self._cache['lic'].prefetch(pe.package for pe in pfiles['lic'])
 
 		for k, f in pfiles.files.items():
 			cache = self._cache[k]
 			for pe in f:
-				if pe.package not in dbcache:
-					try:
-						dbcache[pe.package] = bool(self._dbapi.xmatch('match-all', pe.package))
-					except (InvalidAtom, AmbiguousPackageName):
-						dbcache[pe.package] = False
-
-				if dbcache[pe.package]:
+				if res.best(pe.package) is not None:
 					flags = cache[pe.package]
 					for flag in set(x.name for x in pe):
 						if k == 'kw' and (flag == '*' or flag == '**' or flag == '~*'):
@@ -72,23 +67,17 @@ class DropUnmatchedFlags(BaseCleanupAction):
 
 class DropUnmatchedPkgs(BaseCleanupAction):
 	def _perform(self, f):
-		cache = {}
-
 		class AllMatcher(object):
 			def __eq__(self, other):
 				return True
 
 		am = AllMatcher()
+		res = self._cache.resolver
+		res.precompute(pe.package for pe in f)
 
 		for pe in f:
-			if pe.package not in cache:
-				try:
-					cache[pe.package] = bool(self._dbapi.xmatch('match-all', pe.package))
-				except (InvalidAtom, AmbiguousPackageName):
-					cache[pe.package] = False
-
 			# implicitly remove the package through removing all of its flags
-			if not cache[pe.package]:
+			if res.best(pe.package) is None:
 				del pe[am]
 
 
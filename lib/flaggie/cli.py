@@ -9,18 +9,17 @@ import os
 import os.path
 import sys
 
-from portage import create_trees
-from portage.dbapi.dep_expand import dep_expand
-from portage.dep import Atom
-from portage.exception import AmbiguousPackageName, InvalidAtom
-
 from flaggie import PV
-from flaggie.action import (Action, ActionSet, NotAnAction,
+from flaggie.action import (Action, ActionSet, NotAnAction, OutputAction,
 		ParserError, ParserWarning)
 from flaggie.cache import Caches
 from flaggie.cleanup import (DropIneffective, DropUnmatchedPkgs,
 		DropUnmatchedFlags, SortEntries, SortFlags, MigrateFiles)
-from flaggie.packagefile import PackageFiles
+from flaggie.lock import ConcurrentModification
+from flaggie.md5cache import Md5CacheDBAPI
+from flaggie.packagefile import PackageFiles, ShardingError, preload_files
+from flaggie.pipeline import Task
+from flaggie.stats import InstrumentedDBAPI, Stats
 
 
 def parse_actions(args, dbapi, cache, quiet=False, strict=False,
@@ -35,21 +34,7 @@ def parse_actions(args, dbapi, cache, quiet=False, strict=False,
 			try:
 				act = Action(a, output=dataout)
 			except NotAnAction:
-				try:
-					atom = dep_expand(a, mydb=dbapi, settings=dbapi.settings)
-					if atom.startswith('null/'):
-						raise InvalidAtom(atom)
-				except AmbiguousPackageName as e:
-					raise ParserError('ambiguous package name, matching: %s' % e)
-				except InvalidAtom as e:
-					try:
-						try:
-							atom = Atom(a, allow_wildcard=True)
-						except TypeError:
-							atom = Atom(a)
-					except InvalidAtom as e:
-						raise ParserError('invalid package atom: %s' % e)
-				actset.append(atom)
+				actset.append(cache.resolver.expand(a))
 			except ParserWarning as w:
 				actset.append(act)
 				raise
@@ -81,10 +66,40 @@ def parse_actions(args, dbapi, cache, quiet=False, strict=False,
 	return out
 
 
+def join_preload(task, path, usercpath):
+	""" Return the package.* files preloaded by task if they were
+		read from usercpath, or None. """
+	if task is None or os.path.realpath(path) != os.path.realpath(usercpath):
+		return None
+	try:
+		return task.result()
+	except (IOError, OSError):
+		# let PackageFiles retry and report it
+		return None
+
+
 def main(argv):
 	cleanup_actions = set()
 	quiet = False
 	strict = False
+	stats = None
+	memreport = None
+	md5cache = False
+	snapshot = None
+	compile_to = None
+	fleet = None
+	jobs = None
+	sharded = False
+	shard_files = False
+	queries = []
+	profile = False
+	converge = None
+	plan_only = False
+	match = 'repo'
+	journal = False
+	undo = None
+	complete = None
+	pretend = False
 
 	locale.setlocale(locale.LC_ALL, '')
 	# Python3 does std{in,out,err} and argv recoding implicitly
@@ -111,6 +126,22 @@ def main(argv):
 Options:
 	--quiet			Silence argument errors and warnings
 	--strict		Abort if at least a single flag is invalid
+	--stats			Print dbapi call and cache hit statistics
+	--memory-report		Print memory usage of the main phases
+				and the top allocating flaggie classes
+	--md5-cache		Read package metadata directly from md5-cache
+				(falling back to portage if missing or stale)
+	--snapshot=<path>	Use the repository metadata snapshot
+	--match=<mode>		Match packages against the repositories ('repo',
+				the default), installed packages ('installed')
+				or both ('both')
+	--compile-snapshot=<path>
+				Compile a repository metadata snapshot and exit
+
+	--fleet=<file>		Apply the actions to every PORTAGE_CONFIGROOT
+				listed in the file (one per line)
+	--jobs=<n>		Number of parallel jobs for --fleet
+				and --compile-snapshot
 
 	--drop-ineffective	Drop ineffective flags (those which are
 				overriden by later declarations)
@@ -129,6 +160,37 @@ Options:
 	--migrate-files		Migrate the outdated files to newer variants
 				(package.keywords -> package.accept_keywords)
 
+	--profile		Print the effective USE flags for '?' actions,
+				including the profile, make.conf and IUSE
+				defaults; forced and masked flags are printed
+				as (+flag) and (-flag)
+
+	--find=<arg>		Print all occurences of a flag, keyword or license
+				in package.* files and make.conf (<arg> can be
+				prefixed with '+', '-' and a namespace, e.g.
+				'-use::systemd', and can be a wildcard)
+
+	--converge=<file>	Bring package.* files to the desired state
+				described in the JSON file
+	--plan			Print the changes needed for --converge
+				instead of applying them
+
+	--sharded		Add new entries to per-category files inside
+				package.* directories
+	--shard-files		Split package.* files into per-category files
+				(implies --sharded)
+
+	--pretend		Print the changes as a unified diff instead
+				of writing them
+
+	--journal		Record the changes in a journal instead of keeping
+				full file~ backups
+	--undo[=<n>]		Revert the <n> (default: 1) latest changes
+				recorded in the journal
+
+	--complete <args>...	Print the shell completions for the last
+				of <args> (all the following arguments)
+
 Global actions are applied to the make.conf file. Actions are applied to
 the package.* files, for the packages preceding them.
 
@@ -150,6 +212,31 @@ format as taken by emerge).\n''' % os.path.basename(argv[0]))
 				quiet = True
 			elif a == '--strict':
 				strict = True
+			elif a == '--stats':
+				stats = Stats()
+			elif a == '--memory-report':
+				from flaggie.memreport import MemoryReport
+				memreport = MemoryReport()
+			elif a == '--md5-cache':
+				md5cache = True
+			elif a.startswith('--match='):
+				from flaggie.matchdb import MATCH_MODES
+				match = a[len('--match='):]
+				if match not in MATCH_MODES:
+					output.write('Error: invalid --match value: %s\n' % a)
+					return 1
+			elif a.startswith('--snapshot='):
+				snapshot = a[len('--snapshot='):]
+			elif a.startswith('--compile-snapshot='):
+				compile_to = a[len('--compile-snapshot='):]
+			elif a.startswith('--fleet='):
+				fleet = a[len('--fleet='):]
+			elif a.startswith('--jobs='):
+				try:
+					jobs = int(a[len('--jobs='):])
+				except ValueError:
+					output.write('Error: invalid --jobs value: %s\n' % a)
+					return 1
 			elif a == '--drop-ineffective':
 				cleanup_actions.add(DropIneffective)
 			elif a == '--sort-entries':
@@ -175,6 +262,36 @@ format as taken by emerge).\n''' % os.path.basename(argv[0]))
 				cleanup_actions.add(DropUnmatchedFlags)
 			elif a == '--migrate-files':
 				cleanup_actions.add(MigrateFiles)
+			elif a.startswith('--converge='):
+				converge = a[len('--converge='):]
+			elif a == '--plan':
+				plan_only = True
+			elif a == '--profile':
+				profile = True
+			elif a.startswith('--find='):
+				queries.append(a[len('--find='):])
+			elif a == '--sharded':
+				sharded = True
+			elif a == '--shard-files':
+				sharded = True
+				shard_files = True
+			elif a == '--pretend':
+				pretend = True
+			elif a == '--journal':
+				journal = True
+			elif a == '--undo' or a.startswith('--undo='):
+				try:
+					undo = int(a[len('--undo='):] or 1)
+				except ValueError:
+					undo = 0
+				if undo < 1:
+					output.write('Error: invalid --undo value: %s\n' % a)
+					return 1
+			elif a == '--complete':
+				i = argv.index(a)
+				complete = argv[i + 1:]
+				del argv[i:]
+				break
 			elif a == '--':
 				argv.remove(a)
 				break
@@ -183,28 +300,213 @@ format as taken by emerge).\n''' % os.path.basename(argv[0]))
 				return 1
 			argv.remove(a)
 
+	# read the configuration files while portage sets up the trees;
+	# the results are joined when the actions need them
+	preload_path = os.path.join(os.environ.get('PORTAGE_CONFIGROOT') or '/',
+			'etc', 'portage')
+
+	if fleet is not None:
+		# the fleet workers only apply the actions and write the files
+		for opt, val in (('--pretend', pretend), ('--find', queries),
+				('--converge', converge is not None),
+				('--shard-files', shard_files), ('--sharded', sharded),
+				('--journal', journal), ('--undo', undo is not None)):
+			if val:
+				output.write('Error: %s can not be used with --fleet\n' % opt)
+				return 1
+
+	if complete is not None:
+		from flaggie.complete import complete as complete_args
+		complete_args(complete, dataout)
+		return 0
+
+	if undo is not None:
+		# the journal has everything needed, so skip portage
+		from flaggie.journal import (Journal, JournalError, journal_path,
+				unified_diff)
+		journal = Journal(journal_path(preload_path))
+		try:
+			if pretend:
+				changes = journal.undo_changes(undo)
+			else:
+				records = journal.undo(undo)
+		except (ConcurrentModification, JournalError) as e:
+			output.write('Error: unable to undo: %s\n' % e)
+			return 1
+		if pretend:
+			for path, old, new, ops in changes:
+				dataout.write(''.join(unified_diff(path, old, new, ops)))
+			return 0
+		for rec in records:
+			output.write('Reverted: %s\n' % ' '.join(
+				fc['path'] for fc in rec['files']))
+		return 0
+
+	preload = None
+	if compile_to is None and fleet is None:
+		preload = Task(preload_files, preload_path, sharded)
+
+	from portage import create_trees
+
 	trees = create_trees(
 		config_root=os.environ.get('PORTAGE_CONFIGROOT'),
 		target_root=os.environ.get('ROOT'))
 	porttree = trees[max(trees)]['porttree'].dbapi
+	if stats is not None:
+		porttree = InstrumentedDBAPI(porttree, stats)
+	if md5cache:
+		porttree = Md5CacheDBAPI(porttree, stats)
+	if match != 'repo':
+		if snapshot is not None or compile_to is not None:
+			output.write('Error: snapshots can not be used with --match=%s\n'
+					% match)
+			return 1
+		from flaggie.matchdb import MatchDBAPI
+		porttree = MatchDBAPI(porttree, trees[max(trees)]['vartree'].dbapi,
+				match)
+	if memreport is not None:
+		memreport.phase('create-trees')
 
-	cache = Caches(porttree)
-	act = parse_actions(argv[1:], porttree, cache,
-			quiet=quiet, strict=strict, cleanupact=cleanup_actions,
-			output=output, dataout=dataout)
-	if act is None:
-		return 1
-	if not act:
-		main([argv[0], '--help'])
+	if compile_to is not None:
+		from flaggie.snapshot import compile_snapshot
+		compile_snapshot(compile_to, porttree, Caches(porttree, stats=stats),
+				jobs=jobs)
 		return 0
+	if snapshot is not None:
+		from flaggie.snapshot import InvalidSnapshot, Snapshot
+		try:
+			snapshot = Snapshot(snapshot)
+			snapshot.check(porttree)
+		except (IOError, OSError, InvalidSnapshot) as e:
+			output.write('Error: unable to load snapshot: %s\n' % e)
+			return 1
+
+	try:
+		if queries:
+			from flaggie.reverse import find
+
+			confroot = porttree.settings['PORTAGE_CONFIGROOT']
+			usercpath = os.path.join(confroot, 'etc', 'portage')
+			pfiles = PackageFiles(usercpath, porttree, sharded=sharded,
+					preloaded=join_preload(preload, preload_path, usercpath))
+			try:
+				for o in find(pfiles, queries):
+					dataout.write('%s\n' % o.toString())
+			except ParserError as e:
+				output.write('Error: %s\n' % e)
+				return 1
+			return 0
 
-	confroot = porttree.settings['PORTAGE_CONFIGROOT']
-	usercpath = os.path.join(confroot, 'etc', 'portage')
-	pfiles = PackageFiles(usercpath, porttree)
+		cache = Caches(porttree, stats=stats, snapshot=snapshot)
+		warm = cache.warm()
+		if profile:
+			from flaggie.profile import load_profile
+			cache.profile = load_profile(porttree, cache.resolver)
+		act = parse_actions(argv[1:], porttree, cache,
+				quiet=quiet, strict=strict, cleanupact=cleanup_actions,
+				output=output, dataout=dataout)
+		if memreport is not None:
+			memreport.phase('parse-actions')
+		if act is None:
+			return 1
+		if not act and not shard_files and converge is None:
+			main([argv[0], '--help'])
+			return 0
 
-	for actset in act:
-		actset(pfiles)
+		if fleet is not None:
+			from flaggie.fleet import apply_fleet, read_fleet_file, report_fleet
+			try:
+				roots = read_fleet_file(fleet)
+			except (IOError, OSError) as e:
+				output.write('Error: unable to read fleet file: %s\n' % e)
+				return 1
+			# the warm thread may hold the cache locks, and the forked
+			# workers would inherit them held
+			warm.result()
+			results = apply_fleet(roots, act, porttree, cache, jobs=jobs)
+			return 1 if report_fleet(results, dataout, output) else 0
 
-	pfiles.write()
+		confroot = porttree.settings['PORTAGE_CONFIGROOT']
+		usercpath = os.path.join(confroot, 'etc', 'portage')
+		if converge is not None:
+			from flaggie.converge import Converge, read_state
+			try:
+				state = read_state(converge, ('use', 'kw', 'lic', 'env'),
+						cache.resolver.expand)
+			except (IOError, OSError, ParserError) as e:
+				output.write('Error: unable to read desired state: %s\n' % e)
+				return 1
+
+		preloaded = join_preload(preload, preload_path, usercpath)
+		if journal:
+			from flaggie.journal import Journal, journal_path
+			journal = Journal(journal_path(usercpath))
+		else:
+			journal = None
+		# the actions are redone on every attempt, so collect the query
+		# output and print only the one of the final attempt
+		queryact = [a for actset in act for a in actset
+				if isinstance(a, OutputAction)]
+
+		def print_queries():
+			for p, ns, flags in sink:
+				print(OutputAction.format(p, flags))
+
+		for attempt in range(3):
+			sink = []
+			for a in queryact:
+				a.sink = sink
+			pfiles = PackageFiles(usercpath, porttree, sharded=sharded,
+					preloaded=preloaded, journal=journal)
+			preloaded = None
+			if shard_files:
+				try:
+					for f in pfiles:
+						f.shard()
+				except ShardingError as e:
+					output.write('Error: %s\n' % e)
+					return 1
+
+			for actset in act:
+				actset(pfiles)
+			if converge is not None:
+				conv = Converge(state, pfiles)
+				plan = conv.plan()
+				if plan_only:
+					print_queries()
+					for ns, p, ops in plan:
+						dataout.write('%s\n' % Converge.format(ns, p, ops))
+					return 0
+				conv.apply(plan)
+			if memreport is not None:
+				memreport.phase('apply')
+
+			if pretend:
+				from flaggie.journal import unified_diff
+				print_queries()
+				for path, old, new, ops in pfiles.changes():
+					dataout.write(''.join(unified_diff(path, old, new, ops)))
+				return 0
+
+			try:
+				pfiles.write()
+				if memreport is not None:
+					memreport.phase('write')
+			except ConcurrentModification as e:
+				# the actions are idempotent, so just redo them
+				# on top of the new file contents
+				output.write('%s, retrying.\n' % e)
+			else:
+				print_queries()
+				break
+		else:
+			output.write('Unable to write the files, aborting.\n')
+			return 1
+	finally:
+		if stats is not None:
+			stats.report(output)
+		if memreport is not None:
+			memreport.stop()
+			memreport.report(output)
 
 	return 0
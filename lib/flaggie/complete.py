@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import bisect
+import os
+import os.path
+import re
+
+from flaggie import diskcache
+from flaggie.nameindex import PackageNameIndex
+
+INDEX_VERSION = 1
+NAMESPACES = ('use', 'kw', 'lic', 'env')
+
+# the version suffix of a package file name
+version_regexp = re.compile(
+	r'-[0-9]+(\.[0-9]+)*[a-z]?'
+	r'(_(alpha|beta|pre|rc|p)[0-9]*)*(-r[0-9]+)?$')
+# the atom operator prefix
+operator_regexp = re.compile(r'^[<>=~!]*')
+
+
+def prefixed(l, prefix):
+	""" Return the items of sorted list l starting with prefix. """
+	out = []
+	for i in range(bisect.bisect_left(l, prefix), len(l)):
+		if not l[i].startswith(prefix):
+			break
+		out.append(l[i])
+	return out
+
+
+def atom_cp(atom):
+	""" Strip the operator, version, slot and other suffixes from atom,
+		without needing portage. """
+	atom = operator_regexp.sub('', atom)
+	atom = re.split(r'[:\[]', atom, 1)[0].rstrip('*')
+	return version_regexp.sub('', atom)
+
+
+def read_md5_cache(repos, cp, keys):
+	""" Read keys of all versions of package cp straight from md5-cache
+		of repos. Returns a dict mapping keys to lists of values. """
+	cat, sep, pn = cp.partition('/')
+	out = dict((k, []) for k in keys)
+	if not sep:
+		return out
+
+	for r in repos:
+		d = os.path.join(r, 'metadata', 'md5-cache', cat)
+		try:
+			files = os.listdir(d)
+		except OSError:
+			continue
+		for fn in files:
+			if (not fn.startswith(pn + '-')
+					or not version_regexp.match(fn[len(pn):])):
+				continue
+			try:
+				f = open(os.path.join(d, fn), 'rb')
+			except IOError:
+				continue
+			try:
+				for l in f:
+					k, sep, v = l.decode('utf8').rstrip('\n').partition('=')
+					if k in out:
+						out[k].append(v)
+			finally:
+				f.close()
+	return out
+
+
+class CompletionIndex(object):
+	""" Candidates for shell completion of flaggie arguments. The global
+		flag, keyword and license lists and the repository list are
+		computed once using portage, and stored in the cache directory
+		along with the mtimes of the files they were computed from.
+		As long as they are fresh, portage is not needed at all:
+		the package names come from the package name index, and the flags
+		of a package straight from md5-cache. """
+
+	def __init__(self, config_root):
+		self._config_root = config_root
+		self._name = diskcache.cache_name('complete',
+				os.path.realpath(config_root))
+		self._data = None
+		self._names = None
+		self._pkgindex = None
+
+	@staticmethod
+	def _mtimes(paths):
+		out = {}
+		for p in paths:
+			try:
+				out[p] = os.stat(p).st_mtime
+			except OSError:
+				out[p] = None
+		return out
+
+	def load(self):
+		""" Load the index from the cache. Returns False if it is
+			missing or stale. """
+		data = diskcache.load(self._name)
+		if (data is None or data.get('version') != INDEX_VERSION
+				or self._mtimes(data['mtimes']) != data['mtimes']):
+			return False
+		self._data = data
+		return True
+
+	def build(self, dbapi, cache):
+		""" Build the index using dbapi and the caches, and store it. """
+		repos = list(dbapi.porttrees)
+		paths = [os.path.join(self._config_root, 'etc', x) for x in
+				('make.conf', 'portage/make.conf', 'portage/make.profile',
+					'portage/repos.conf')]
+		for r in repos:
+			paths.extend(os.path.join(r, x) for x in
+					('profiles/use.desc', 'profiles/arch.list',
+						'profiles/license_groups', 'licenses'))
+			paths.extend(os.path.join(r, 'profiles', 'desc',
+					'%s.desc' % x.lower()) for x in cache['use'].use_expand_vars)
+
+		self._data = {
+			'version': INDEX_VERSION,
+			'mtimes': self._mtimes(paths),
+			'repos': repos,
+		}
+		for k in ('use', 'kw', 'lic'):
+			self._data[k] = sorted(cache[k].glob)
+		diskcache.store(self._name, self._data)
+
+	@property
+	def _index(self):
+		""" The package name index, mapping names to categories. """
+		if self._pkgindex is None:
+			self._pkgindex = PackageNameIndex(self._data['repos']).index
+		return self._pkgindex
+
+	@property
+	def names(self):
+		""" Sorted lists of package names and cat/pn pairs. """
+		if self._names is None:
+			index = self._index
+			self._names = (sorted(index),
+					sorted('%s/%s' % (c, pn) for pn, cats in index.items()
+						for c in cats))
+		return self._names
+
+	def packages(self, prefix):
+		pns, cps = self.names
+		if '/' in prefix:
+			return prefixed(cps, prefix)
+		cats = sorted(set(x.split('/', 1)[0] + '/' for x in prefixed(cps, prefix)))
+		return sorted(set(prefixed(pns, prefix)) | set(cats))
+
+	def flags(self, ns, prefix, pkg=None):
+		if ns == 'env':
+			from flaggie.cache import env_dir
+			from flaggie.envindex import EnvIndex
+			return EnvIndex(env_dir()).prefixed(prefix)
+		if pkg is None:
+			return prefixed(self._data[ns], prefix)
+
+		keys = {'use': 'IUSE', 'kw': 'KEYWORDS', 'lic': 'LICENSE'}
+		cp = atom_cp(pkg)
+		if '/' in cp:
+			cps = [cp]
+		else:
+			# short names are resolved through the package name index
+			cps = ['%s/%s' % (c, cp) for c in self._index.get(cp, ())]
+		values = []
+		for cp in cps:
+			values.extend(read_md5_cache(self._data['repos'], cp,
+					(keys[ns],))[keys[ns]])
+		flags = set()
+		for v in values:
+			for x in v.split():
+				if ns == 'use':
+					flags.add(x.lstrip('+-'))
+				elif ns == 'kw':
+					if not x.startswith('-'):
+						flags.add(x)
+				elif x not in ('||', '(', ')') and not x.endswith('?'):
+					flags.add(x)
+		if ns == 'kw':
+			flags.update(('*', '**', '~*'))
+		return sorted(x for x in flags if x.startswith(prefix))
+
+	def complete(self, words):
+		""" Return the candidates for the last of words (the flaggie
+			arguments, with the one being completed last). """
+		cur = words[-1] if words else ''
+		if not cur or cur[0] not in '+-%?':
+			op = operator_regexp.match(cur).group(0)
+			return [op + x for x in self.packages(cur[len(op):])]
+
+		pkg = None
+		for w in reversed(words[:-1]):
+			if w and w[0] not in '+-%?':
+				pkg = w
+				break
+
+		act, arg = cur[0], cur[1:]
+		if '::' in arg:
+			ns, arg = arg.split('::', 1)
+			if ns not in NAMESPACES:
+				return []
+			return ['%s%s::%s' % (act, ns, x)
+					for x in self.flags(ns, arg, pkg)]
+
+		out = set('%s%s::' % (act, ns) for ns in NAMESPACES
+				if ns.startswith(arg))
+		for ns in NAMESPACES:
+			out.update(act + x for x in self.flags(ns, arg, pkg))
+		return sorted(out)
+
+
+def complete(words, output):
+	""" Print the completions for words to output. Portage is used only
+		if the index is missing or stale. """
+	config_root = os.environ.get('PORTAGE_CONFIGROOT') or '/'
+	index = CompletionIndex(config_root)
+	if not index.load():
+		from portage import create_trees
+
+		from flaggie.cache import Caches
+
+		trees = create_trees(config_root=os.environ.get('PORTAGE_CONFIGROOT'),
+				target_root=os.environ.get('ROOT'))
+		dbapi = trees[max(trees)]['porttree'].dbapi
+		index.build(dbapi, Caches(dbapi))
+
+	for x in index.complete(words):
+		output.write('%s\n' % x)
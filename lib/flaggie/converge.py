@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+# The desired state document is a JSON object mapping namespaces
+# ('use', 'kw', 'lic', 'env') to objects mapping packages to either:
+#
+# - an object mapping flag names to true (enabled), false (disabled)
+#   or null (reset, i.e. not present in the files); the flags not
+#   listed are left as-is,
+#
+# - a list of flags ('flag' or '-flag'); all the other flags
+#   of the package are reset.
+#
+# Example:
+#
+#   {"use": {"app-misc/foo": {"doc": true, "systemd": false}},
+#    "kw": {"app-misc/bar": ["~amd64"]}}
+
+import codecs
+import json
+
+from flaggie.action import EffectiveEntryOp, ParserError
+
+try:
+	string_type = basestring
+except NameError:  # py3
+	string_type = str
+
+
+def read_state(path, namespaces, expand=None):
+	""" Read and validate the desired state document at path.
+		Returns a list of (ns, package, flags, exact) tuples, where
+		flags maps flag names to True, False or None. If expand is
+		not None, it is used to expand the package names. """
+	f = codecs.open(path, 'r', 'utf8')
+	try:
+		try:
+			data = json.load(f)
+		except ValueError as e:
+			raise ParserError('invalid JSON in %s: %s' % (path, e))
+	finally:
+		f.close()
+
+	if not isinstance(data, dict):
+		raise ParserError('%s: top-level value is not an object' % path)
+
+	out = []
+	for ns in sorted(data):
+		if ns not in namespaces:
+			raise ParserError('%s: unknown namespace: %s' % (path, ns))
+		pkgs = data[ns]
+		if not isinstance(pkgs, dict):
+			raise ParserError('%s: value for %s is not an object' % (path, ns))
+
+		for p in sorted(pkgs):
+			v = pkgs[p]
+			if isinstance(v, list):
+				exact = True
+				flags = {}
+				for x in v:
+					if not isinstance(x, string_type) or not x.lstrip('+-'):
+						raise ParserError('%s: invalid flag for %s: %r'
+								% (path, p, x))
+					flags[x.lstrip('+-')] = not x.startswith('-')
+			elif isinstance(v, dict):
+				exact = False
+				flags = v
+				for k, x in flags.items():
+					if x is not None and not isinstance(x, bool):
+						raise ParserError('%s: invalid state for %s %s: %r'
+								% (path, p, k, x))
+			else:
+				raise ParserError('%s: invalid value for %s: %r'
+						% (path, p, v))
+
+			if expand is not None:
+				p = str(expand(p))
+			out.append((ns, p, flags, exact))
+	return out
+
+
+class IndexedFileSet(object):
+	""" A PackageFileSet adapter with a package -> entries index,
+		built in a single pass, to be used with grab_effective_entry()
+		instead of scanning all the entries for every lookup. """
+
+	def __init__(self, fileset):
+		self._fileset = fileset
+		self._index = {}
+		for e in fileset:
+			if e.package not in self._index:
+				self._index[e.package] = []
+			self._index[e.package].append(e)
+
+	def __getitem__(self, pkg):
+		""" Iterate over entries for pkg, in order of effectiveness. """
+		return iter(self._index.get(pkg, ()))
+
+	def append(self, pkg):
+		e = self._fileset.append(pkg)
+		# the new entry is the last one, so the most effective
+		self._index.setdefault(pkg, []).insert(0, e)
+		return e
+
+
+class Converge(object):
+	""" Bring the package.* files to the desired state, using
+		the minimal set of enable (+), disable (-) and reset (%)
+		operations. """
+
+	def __init__(self, state, pfiles):
+		self._state = state
+		self._pfiles = pfiles
+		self._indexes = {}
+
+	def _index(self, ns):
+		if ns not in self._indexes:
+			self._indexes[ns] = IndexedFileSet(self._pfiles[ns])
+		return self._indexes[ns]
+
+	def plan(self):
+		""" Return a list of (ns, package, ops) tuples for the packages
+			that need changing, where ops is a list of (op, flag)
+			pairs. """
+		out = []
+		for ns, p, flags, exact in self._state:
+			current = {}
+			for pe in self._index(ns)[p]:
+				for f in pe:
+					if f.name not in current:
+						current[f.name] = f.modifier != '-'
+
+			ops = []
+			for name in sorted(flags):
+				want = flags[name]
+				if want is None:
+					if name in current:
+						ops.append(('%', name))
+				elif current.get(name) != want:
+					ops.append(('+' if want else '-', name))
+			if exact:
+				for name in sorted(current):
+					if name not in flags:
+						ops.append(('%', name))
+
+			if ops:
+				out.append((ns, p, ops))
+		return out
+
+	def apply(self, plan):
+		for ns, p, ops in plan:
+			f = self._index(ns)
+			for op, name in ops:
+				if op == '%':
+					for pe in f[p]:
+						del pe[name]
+				else:
+					fl = EffectiveEntryOp.grab_effective_entry(p, name, f,
+							rw=True)
+					fl.modifier = '' if op == '+' else '-'
+
+	@staticmethod
+	def format(ns, p, ops):
+		""" Format the changes for a package as flaggie arguments. """
+		return ' '.join([p] + ['%s%s::%s' % (op, ns, name)
+				for op, name in ops])
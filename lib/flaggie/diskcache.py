@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+
+def cache_dir():
+	""" Return the directory for persistent flaggie caches. """
+	d = os.environ.get('FLAGGIE_CACHE_DIR')
+	if d:
+		return d
+	d = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+	return os.path.join(d, 'flaggie')
+
+
+def cache_name(prefix, key):
+	""" Return a cache file name for prefix and a key (e.g. a path). """
+	return '%s-%s.json' % (prefix,
+			hashlib.md5(key.encode('utf8')).hexdigest()[:16])
+
+
+def load(name):
+	""" Load the named cache file, returning None if it does not
+		exist or is not readable. """
+	try:
+		f = open(os.path.join(cache_dir(), name), 'r')
+	except (IOError, OSError):
+		return None
+	try:
+		return json.load(f)
+	except ValueError:
+		return None
+	finally:
+		f.close()
+
+
+def store(name, data):
+	""" Store data in the named cache file. Failures are ignored,
+		since the caches are only an optimization. """
+	d = cache_dir()
+	try:
+		if not os.path.isdir(d):
+			os.makedirs(d)
+		f = tempfile.NamedTemporaryFile('w', delete=False, dir=d)
+	except (IOError, OSError):
+		return
+	try:
+		json.dump(data, f)
+		f.close()
+		os.rename(f.name, os.path.join(d, name))
+	except (IOError, OSError):
+		f.close()
+		os.unlink(f.name)
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import bisect
+import fnmatch
+import os
+import os.path
+import re
+
+from flaggie import diskcache
+from flaggie.complete import prefixed
+
+INDEX_VERSION = 1
+
+# the first wildcard character in a pattern
+wildcard_regexp = re.compile(r'[*?[]')
+
+
+class EnvIndex(object):
+	""" A sorted index of the files in the env directory (as paths
+		relative to it), built on first use. The index is persisted
+		in the cache directory, and considered fresh as long as the mtimes
+		of all the directories are unchanged (adding, removing or renaming
+		a file changes the mtime of its directory). """
+
+	def __init__(self, path):
+		self._path = path
+		self._files = None
+
+	def _dir_mtimes(self, dirs):
+		mtimes = {}
+		for d in dirs:
+			try:
+				mtimes[d] = os.stat(os.path.join(self._path, d)).st_mtime
+			except OSError:
+				mtimes[d] = None
+		return mtimes
+
+	def _load(self):
+		name = diskcache.cache_name('env', os.path.realpath(self._path))
+		data = diskcache.load(name)
+		if (data is not None and data.get('version') == INDEX_VERSION
+				and self._dir_mtimes(data['dirs']) == data['dirs']):
+			return data['files']
+
+		dirs = ['.']
+		files = []
+		for parent, wdirs, wfiles in os.walk(self._path):
+			rel = os.path.relpath(parent, self._path)
+			dirs.extend(os.path.normpath(os.path.join(rel, x)) for x in wdirs)
+			files.extend(os.path.normpath(os.path.join(rel, x)) for x in wfiles)
+		files.sort()
+
+		diskcache.store(name, {
+			'version': INDEX_VERSION,
+			'dirs': self._dir_mtimes(dirs),
+			'files': files,
+		})
+		return files
+
+	@property
+	def files(self):
+		if self._files is None:
+			self._files = self._load()
+		return self._files
+
+	def __contains__(self, k):
+		i = bisect.bisect_left(self.files, k)
+		return i < len(self.files) and self.files[i] == k
+
+	def __iter__(self):
+		return iter(self.files)
+
+	def __len__(self):
+		return len(self.files)
+
+	def prefixed(self, prefix):
+		""" Return the files starting with prefix. """
+		return prefixed(self.files, prefix)
+
+	def match(self, pattern):
+		""" Return the files matching the wildcard pattern. """
+		prefix = wildcard_regexp.split(pattern, 1)[0]
+		return [x for x in self.prefixed(prefix)
+				if fnmatch.fnmatchcase(x, pattern)]
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import multiprocessing
+import os
+import os.path
+
+from portage import config
+
+from flaggie.action import EffectiveEntryOp, OutputAction, Pattern
+from flaggie.packagefile import PackageFiles
+
+# the state shared with the forked workers
+_fleet_state = None
+
+
+def read_fleet_file(path):
+	""" Read config roots from path, one per line. """
+	roots = []
+	f = open(path, 'r')
+	for l in f:
+		l = l.split('#', 1)[0].strip()
+		if l:
+			roots.append(l)
+	f.close()
+	return roots
+
+
+def warm_caches(act, cache):
+	""" Fill the metadata caches needed by the actions, so that
+		the workers share them instead of rebuilding each. """
+	for actset in act:
+		for a in actset:
+			if not isinstance(a, EffectiveEntryOp):
+				continue
+			if not any(isinstance(x, Pattern) for x in a.args):
+				continue
+			for ns in a.ns:
+				for p in actset.pkgs:
+					cache[ns].get_effective(p)
+
+
+def _apply_root(root):
+	act, dbapi = _fleet_state
+	sink = []
+	try:
+		settings = config(config_root=root,
+				target_root=os.environ.get('ROOT'))
+		pfiles = PackageFiles(os.path.join(root, 'etc', 'portage'),
+				dbapi, settings=settings)
+		for actset in act:
+			for a in actset:
+				if isinstance(a, OutputAction):
+					a.sink = sink
+			actset(pfiles)
+		pfiles.write()
+	except Exception as e:
+		return (root, [], '%s: %s' % (e.__class__.__name__, e))
+	return (root, [OutputAction.format(p, flags)
+		for p, ns, flags in sink], None)
+
+
+def apply_fleet(roots, act, dbapi, cache, jobs=None):
+	""" Apply the parsed action sets to every config root in roots,
+		using a process pool. The (already warm) caches are shared
+		with the workers through fork(). Returns a list of
+		(root, output lines, error or None) tuples, in roots order. """
+
+	global _fleet_state
+
+	warm_caches(act, cache)
+	_fleet_state = (act, dbapi)
+	try:
+		try:
+			ctx = multiprocessing.get_context('fork')
+		except AttributeError:  # py2
+			ctx = multiprocessing
+		pool = ctx.Pool(jobs)
+		try:
+			return pool.map(_apply_root, roots)
+		finally:
+			pool.close()
+			pool.join()
+	finally:
+		_fleet_state = None
+
+
+def report_fleet(results, dataout, output):
+	failed = 0
+	for root, lines, err in results:
+		for l in lines:
+			dataout.write('%s: %s\n' % (root, l))
+		if err is not None:
+			failed += 1
+			output.write('%s: failed: %s\n' % (root, err))
+	output.write('Fleet: %d config roots, %d succeeded, %d failed\n'
+			% (len(results), len(results) - failed, failed))
+	return failed
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+# The journal is an append-only file with one JSON record per line.
+# Every write of the package.* files and make.conf adds a record:
+#
+#   {"time": 1500000000.0, "files": [{"path": "/etc/portage/package.use",
+#     "ops": [[i1, j1, [old lines...], [new lines...]], ...]}]}
+#
+# where old lines at i1 (in the old file) were replaced by new lines
+# at j1 (in the new file). The unchanged lines are not stored.
+# An undo adds a record:
+#
+#   {"time": 1500000000.0, "undo": n}
+#
+# that reverts the n latest (not yet reverted) records.
+
+import codecs
+import difflib
+import errno
+import fcntl
+import json
+import os
+import os.path
+import time
+
+from flaggie.lock import FileLock, file_identity
+
+
+class JournalError(Exception):
+	pass
+
+
+def journal_path(basedir):
+	""" Return the path to the journal for config directory basedir. """
+	return os.path.join(basedir, '.flaggie.journal')
+
+
+def diff_lines(old, new):
+	""" Return the journal ops turning the old list of lines into
+		the new one. """
+	ops = []
+	sm = difflib.SequenceMatcher(None, old, new, autojunk=False)
+	for tag, i1, i2, j1, j2 in sm.get_opcodes():
+		if tag != 'equal':
+			ops.append([i1, j1, old[i1:i2], new[j1:j2]])
+	return ops
+
+
+def format_range(start, stop):
+	""" Format a range of lines for a unified diff hunk header. """
+	if stop - start == 1:
+		return '%d' % (start + 1)
+	if stop == start:
+		return '%d,0' % start
+	return '%d,%d' % (start + 1, stop - start)
+
+
+def unified_diff(path, old, new, ops, context=3):
+	""" Format the journal ops turning the old list of lines into the new
+		one as a unified diff. Returns a list of lines. """
+	hunks = []
+	for op in ops:
+		if hunks:
+			prev = hunks[-1][-1]
+			if op[0] - (prev[0] + len(prev[2])) <= 2 * context:
+				hunks[-1].append(op)
+				continue
+		hunks.append([op])
+
+	def line(prefix, l):
+		if not l.endswith('\n'):
+			return '%s%s\n\\ No newline at end of file\n' % (prefix, l)
+		return prefix + l
+
+	out = []
+	if hunks:
+		out.append('--- %s\n' % path)
+		out.append('+++ %s\n' % path)
+	for h in hunks:
+		i1 = max(0, h[0][0] - context)
+		j1 = h[0][1] - (h[0][0] - i1)
+		end = h[-1][0] + len(h[-1][2])
+		i2 = min(len(old), end + context)
+		j2 = h[-1][1] + len(h[-1][3]) + (i2 - end)
+		out.append('@@ -%s +%s @@\n' % (format_range(i1, i2),
+			format_range(j1, j2)))
+
+		pos = i1
+		for oi, oj, o, n in h:
+			out.extend(line(' ', l) for l in old[pos:oi])
+			out.extend(line('-', l) for l in o)
+			out.extend(line('+', l) for l in n)
+			pos = oi + len(o)
+		out.extend(line(' ', l) for l in old[pos:i2])
+	return out
+
+
+def split_lines(data):
+	""" Split data into lines, keeping the newlines. """
+	lines = data.split('\n')
+	last = lines.pop()
+	lines = [l + '\n' for l in lines]
+	if last:
+		lines.append(last)
+	return lines
+
+
+def read_lines(path):
+	try:
+		f = codecs.open(path, 'r', 'utf8')
+	except IOError as e:
+		if e.errno != errno.ENOENT:
+			raise
+		return []
+	try:
+		return split_lines(f.read())
+	finally:
+		f.close()
+
+
+class RevertedFile(object):
+	""" A file being reverted to its state before journal records,
+		to be written via PendingWrite. """
+
+	def __init__(self, path):
+		self.path = path
+		with FileLock(path):
+			self._identity = file_identity(path)
+			self.lines = read_lines(path)
+		self.old_lines = list(self.lines)
+
+	def revert(self, ops):
+		""" Undo the ops, verifying that the new lines are still
+			in place. """
+		for i1, j1, old, new in reversed(ops):
+			if self.lines[j1:j1 + len(new)] != new:
+				raise JournalError('%s was modified since the change' % self.path)
+			self.lines[j1:j1 + len(new)] = old
+
+	@property
+	def data(self):
+		return ''.join(self.lines)
+
+	def _written(self, identity, data):
+		self._identity = identity
+
+
+class Journal(object):
+	""" The change journal at path. """
+
+	def __init__(self, path):
+		self.path = path
+		self._fd = None
+
+	def __enter__(self):
+		""" Lock the journal. It needs to be held while writing
+			the files, so that the records are in order. """
+		self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+				0o644)
+		fcntl.flock(self._fd, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		fcntl.flock(self._fd, fcntl.LOCK_UN)
+		os.close(self._fd)
+		self._fd = None
+
+	def _append(self, rec):
+		rec['time'] = time.time()
+		l = json.dumps(rec, sort_keys=True, separators=(',', ':')) + '\n'
+		os.write(self._fd, l.encode('utf8'))
+
+	def record(self, changes):
+		""" Append a record for the (path, ops) changes. Needs to be
+			called with the journal locked. """
+		changes = [{'path': p, 'ops': ops} for p, ops in changes if ops]
+		if changes:
+			self._append({'files': changes})
+
+	def changes(self):
+		""" Return the list of records that were not reverted yet,
+			oldest first. """
+		stack = []
+		for i, l in enumerate(read_lines(self.path), 1):
+			try:
+				rec = json.loads(l)
+			except ValueError:
+				if not l.endswith('\n'):
+					# a partial write, ignore it
+					break
+				raise JournalError('%s:%d: invalid record' % (self.path, i))
+			if 'undo' in rec:
+				del stack[len(stack) - rec['undo']:]
+			else:
+				stack.append(rec)
+		return stack
+
+	def _revert(self, count):
+		""" Return the count latest records, and the RevertedFiles
+			with the changes reverted. Needs to be called with
+			the journal locked. """
+		stack = self.changes()
+		if count > len(stack):
+			raise JournalError('only %d change(s) in the journal'
+					% len(stack))
+		records = stack[len(stack) - count:]
+
+		files = {}
+		for rec in reversed(records):
+			for fc in rec['files']:
+				if fc['path'] not in files:
+					files[fc['path']] = RevertedFile(fc['path'])
+				files[fc['path']].revert(fc['ops'])
+		return records, files
+
+	def undo(self, count=1):
+		""" Revert the count latest changes. Either all the files
+			are reverted, or none of them. Returns the list of records
+			reverted. """
+		from flaggie.packagefile import PendingWrite, commit_writes
+
+		with self:
+			records, files = self._revert(count)
+			commit_writes([PendingWrite(f, f.data) for f in files.values()],
+					backup=False)
+			self._append({'undo': count})
+		return records
+
+	def undo_changes(self, count=1):
+		""" Return the (path, old lines, new lines, ops) tuples that
+			undo(count) would write, without writing anything. """
+		with self:
+			records, files = self._revert(count)
+		return [(p, f.old_lines, f.lines, diff_lines(f.old_lines, f.lines))
+				for p, f in sorted(files.items())]
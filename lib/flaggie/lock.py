@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import errno
+import fcntl
+import os
+import os.path
+
+
+class ConcurrentModification(Exception):
+	pass
+
+
+def file_identity(path):
+	""" Return a tuple identifying the current contents of path,
+		or None if it does not exist. """
+	try:
+		st = os.stat(path)
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+		return None
+	return (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+
+class FileLock(object):
+	""" An advisory lock for path. Since files are replaced through
+		rename(), the lock is taken on a separate dotfile next to it
+		(dotfiles are skipped when reading package.* directories).
+		The lock files are never removed, since removing them would
+		race with other processes locking them.
+
+		Shared locks are best-effort: if the lock file can not be
+		created (e.g. when querying as a regular user), the file is
+		read unlocked. """
+
+	def __init__(self, path, exclusive=False):
+		d, fn = os.path.split(path)
+		self.path = os.path.join(d, '.%s.lock' % fn)
+		self.exclusive = exclusive
+		self._fd = None
+
+	def __enter__(self):
+		if self.exclusive:
+			d = os.path.dirname(self.path)
+			if not os.path.isdir(d):
+				os.makedirs(d)
+			self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+		else:
+			try:
+				self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+			except OSError as e:
+				if e.errno not in (errno.EACCES, errno.EPERM, errno.EROFS,
+						errno.ENOENT):
+					raise
+				try:
+					self._fd = os.open(self.path, os.O_RDONLY)
+				except OSError:
+					return self
+
+		fcntl.flock(self._fd,
+				fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		if self._fd is not None:
+			fcntl.flock(self._fd, fcntl.LOCK_UN)
+			os.close(self._fd)
+			self._fd = None
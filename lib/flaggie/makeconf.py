@@ -0,0 +1,328 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import codecs
+import os
+import os.path
+import re
+
+from flaggie.journal import diff_lines, split_lines
+from flaggie.lock import FileLock, file_identity
+from flaggie.packagefile import (PackageEntry, PackageFlag,
+		PackageFlagGroup, PendingWrite, commit_writes, file_changes)
+
+assign_regexp = re.compile(r'[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)=')
+
+# path -> (file identity, parsed segments)
+_parse_cache = {}
+
+
+def parse_makeconf(data):
+	""" Split make.conf contents into a tuple of segments. Each segment
+		is either a verbatim string or a (var, prefix, value, suffix,
+		quote) tuple for a variable assignment, with prefix and suffix
+		containing the surrounding text of the same line(s). """
+
+	out = []
+	pos = 0
+	while pos < len(data):
+		eol = data.find('\n', pos)
+		eol = len(data) if eol == -1 else eol + 1
+
+		m = assign_regexp.match(data, pos)
+		if m is None:
+			out.append(data[pos:eol])
+			pos = eol
+			continue
+
+		vstart = m.end()
+		quote = data[vstart:vstart + 1]
+		if quote in ('"', "'"):
+			i = vstart + 1
+			while i < len(data) and data[i] != quote:
+				if data[i] == '\\' and quote == '"':
+					i += 1
+				i += 1
+			if i >= len(data):  # unterminated, leave it alone
+				out.append(data[pos:])
+				break
+			prefix = data[pos:vstart + 1]
+			value = data[vstart + 1:i]
+			send = data.find('\n', i)
+			send = len(data) if send == -1 else send + 1
+			suffix = data[i:send]
+		else:
+			quote = ''
+			i = vstart
+			while i < len(data) and data[i] not in ' \t\n#':
+				i += 1
+			prefix = data[pos:vstart]
+			value = data[vstart:i]
+			suffix = data[i:eol]
+			send = eol
+
+		out.append((m.group(1), prefix, value, suffix, quote))
+		pos = send
+
+	return tuple(out)
+
+
+def read_makeconf(path):
+	""" Parse path, reusing the previous result if the file did not
+		change since. Returns a tuple of file identity and segments. """
+	ident = file_identity(path)
+	if ident is None:
+		return (None, ())
+	cached = _parse_cache.get(path)
+	if cached is not None and cached[0] == ident:
+		return cached
+
+	with FileLock(path):
+		ident = file_identity(path)
+		f = codecs.open(path, 'r', 'utf8')
+		try:
+			segs = parse_makeconf(f.read())
+		finally:
+			f.close()
+	_parse_cache[path] = (ident, segs)
+	return (ident, segs)
+
+
+class MakeConfEntry(PackageEntry):
+	""" A single variable assignment in make.conf, acting like
+		a package entry with no package. Variable references (${USE})
+		are kept verbatim in front of the flags. USE_EXPAND variables
+		have all their flags in a single group. """
+
+	path = None
+
+	def __init__(self, var, prefix, value, suffix, quote, group=False):
+		self.var = var
+		self.package = None
+		self.whitespace = []
+		self.modified = False
+		self.flags = []
+		self.flag_groups = []
+		self.refs = []
+		self.prefix = prefix
+		self.suffix = suffix
+		self.quote = quote
+		self.as_str = prefix + value + suffix
+
+		group_name = None
+		target = self.flags
+		if group:
+			group_name = var
+			g = PackageFlagGroup(var)
+			self.flag_groups.append(g)
+			target = g.flags
+
+		for x in value.replace('\\\n', ' ').split():
+			if x.startswith('$'):
+				self.refs.append(x)
+			else:
+				target.append(PackageFlag(x, group_name))
+
+	@property
+	def incremental(self):
+		""" Whether the assignment extends the previous value. """
+		return ('$%s' % self.var in self.refs
+				or '${%s}' % self.var in self.refs)
+
+	def toString(self):
+		if not self.modified:
+			return self.as_str
+
+		value = ' '.join(self.refs + [x.toString() for x in self.flags]
+				+ [x.subToString() for g in self.flag_groups for x in g])
+		prefix = self.prefix
+		suffix = self.suffix
+		if not self.quote and ' ' in value:
+			prefix += '"'
+			suffix = '"' + suffix
+		return prefix + value + suffix
+
+
+class MakeConfFile(object):
+	def __init__(self, path, group_vars):
+		self.path = path
+		self.segments = []
+		self._modified = False
+		self._identity, segs = read_makeconf(path)
+		lineno = 1
+		for s in segs:
+			if not isinstance(s, tuple):
+				self.segments.append(s)
+				lineno += s.count('\n')
+			else:
+				e = MakeConfEntry(*s, group=(s[0] in group_vars))
+				e.path = path
+				e.lineno = lineno
+				self.segments.append(e)
+				lineno += e.as_str.count('\n')
+		# the lines as read, for journal deltas
+		self._lines = split_lines(self.data)
+
+	def entries(self):
+		for s in self.segments:
+			if isinstance(s, MakeConfEntry):
+				yield s
+
+	def append(self, entry):
+		if self.segments:
+			last = self.segments[-1]
+			if isinstance(last, MakeConfEntry):
+				last = last.suffix
+			if not last.endswith('\n'):
+				self.segments.append('\n')
+		self.segments.append(entry)
+		self._modified = True
+
+	@property
+	def modified(self):
+		if self._modified:
+			return True
+		for e in self.entries():
+			if e.modified:
+				return True
+		return False
+
+	@property
+	def data(self):
+		return ''.join(s.toString() if isinstance(s, MakeConfEntry) else s
+				for s in self.segments)
+
+	def prepare(self):
+		""" Return a PendingWrite for the file, or None if it was
+			not modified. """
+		if not self.modified:
+			return None
+		return PendingWrite(self, self.data)
+
+	def _delta(self, data):
+		return diff_lines(self._lines, split_lines(data))
+
+	def _written(self, identity, data):
+		self._identity = identity
+		self._lines = split_lines(data)
+		# the new contents are already known, so prime the cache
+		if self._identity is not None:
+			_parse_cache[self.path] = (self._identity, parse_makeconf(data))
+
+		for e in self.entries():
+			e.as_str = e.toString()
+			e.modified = False
+		self._modified = False
+
+	def write(self):
+		p = self.prepare()
+		if p is not None:
+			commit_writes([p])
+
+
+class MakeConf(object):
+	""" make.conf (either a file or a directory), possibly
+		preceded by the legacy /etc/make.conf. """
+
+	def __init__(self, paths, group_vars=()):
+		self._paths = paths
+		self._group_vars = frozenset(group_vars)
+		self._files = []
+
+	@property
+	def files(self):
+		if not self._files:
+			for fn in self._paths:
+				if os.path.isdir(fn):
+					files = []
+					for toppath, wdirs, wfiles in os.walk(fn):
+						for f in wfiles:
+							if f.startswith('.') or f.endswith('~'):
+								continue
+							files.append(os.path.join(toppath, f))
+					files.sort()
+				elif os.path.exists(fn):
+					files = [fn]
+				else:
+					files = []
+				for f in files:
+					self._files.append(MakeConfFile(f, self._group_vars))
+
+			if not self._files:
+				self._files.append(MakeConfFile(self._paths[-1],
+					self._group_vars))
+		return self._files
+
+	def entries(self, variables):
+		""" Iterate over the assignments to variables, in the order
+			of effectiveness. The iteration stops on the last
+			non-incremental assignment of each variable. """
+		done = set()
+		for f in reversed(self.files):
+			for e in reversed(list(f.entries())):
+				if e.var in variables and e.var not in done:
+					yield e
+					if not e.incremental:
+						done.add(e.var)
+
+	def append(self, var):
+		f = self.files[-1]
+		e = MakeConfEntry(var, '%s="' % var, '', '"\n', '"',
+				group=(var in self._group_vars))
+		for x in self.files:
+			for pe in x.entries():
+				if pe.var == var:
+					e.refs.append('${%s}' % var)
+					break
+			if e.refs:
+				break
+		e.modified = True
+		e.path = f.path
+		f.append(e)
+		return e
+
+	def prepare(self):
+		""" Return a list of PendingWrites for all modified files. """
+		pending = []
+		try:
+			for f in self._files:
+				p = f.prepare()
+				if p is not None:
+					pending.append(p)
+		except Exception:
+			for p in pending:
+				p.abort()
+			raise
+		return pending
+
+	def changes(self):
+		""" Return the changes to the files, see file_changes(). """
+		return file_changes(self._files)
+
+	def write(self):
+		if not self._files:
+			return
+
+		commit_writes(self.prepare())
+		self._files = []
+
+
+class MakeConfVarSet(object):
+	""" The global counterpart of a PackageFileSet, covering a set
+		of make.conf variables. New entries go into default_var. """
+
+	def __init__(self, makeconf, variables, default_var):
+		self._makeconf = makeconf
+		self._vars = frozenset(variables)
+		self._default_var = default_var
+
+	def __iter__(self):
+		return self._makeconf.entries(self._vars)
+
+	def append(self):
+		return self._makeconf.append(self._default_var)
+
+	def write(self):
+		self._makeconf.write()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+MATCH_MODES = ('repo', 'installed', 'both')
+
+
+class MatchDBAPI(object):
+	""" A porttree dbapi replacement matching packages against the
+		installed packages (mode 'installed'), or the union of installed
+		and repository packages (mode 'both'). The metadata of installed
+		packages is read from the vdb. Everything else (settings,
+		porttrees...) is taken from the porttree. """
+
+	# the package name index covers the repositories only, so short
+	# names need to be expanded through the dbapi
+	repo_names = False
+
+	def __init__(self, portdb, vardb, mode):
+		if mode not in ('installed', 'both'):
+			raise AssertionError('Invalid match mode: %s' % mode)
+		self._portdb = portdb
+		self._vardb = vardb
+		self._mode = mode
+		self._installed = {}
+
+	def __getattr__(self, k):
+		return getattr(self._portdb, k)
+
+	@property
+	def settings(self):
+		return self._portdb.settings
+
+	def _union(self, a, b):
+		seen = set(a)
+		return a + [x for x in b if x not in seen]
+
+	def _is_installed(self, cpv):
+		if cpv not in self._installed:
+			self._installed[cpv] = bool(self._vardb.cpv_exists(cpv))
+		return self._installed[cpv]
+
+	def match(self, origdep, *args, **kwargs):
+		inst = list(self._vardb.match(origdep))
+		if self._mode == 'installed':
+			return inst
+		return self._union(inst, list(self._portdb.xmatch('match-all', origdep)))
+
+	def xmatch(self, level, origdep, *args, **kwargs):
+		if level != 'match-all':
+			raise NotImplementedError(
+				'xmatch(%s) not supported with --match=%s' % (level, self._mode))
+		return self.match(origdep)
+
+	def cp_list(self, mycp, *args, **kwargs):
+		inst = list(self._vardb.cp_list(mycp))
+		if self._mode == 'installed':
+			return inst
+		return self._union(inst, list(self._portdb.cp_list(mycp)))
+
+	def cp_all(self):
+		inst = list(self._vardb.cp_all())
+		if self._mode == 'installed':
+			return inst
+		return sorted(set(inst) | set(self._portdb.cp_all()))
+
+	def aux_get(self, mycpv, mylist, *args, **kwargs):
+		if self._mode == 'installed' or self._is_installed(mycpv):
+			return self._vardb.aux_get(mycpv, mylist)
+		return self._portdb.aux_get(mycpv, mylist, *args, **kwargs)
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import hashlib
+import os.path
+
+
+def file_md5(path):
+	try:
+		f = open(path, 'rb')
+	except IOError:
+		return None
+	try:
+		return hashlib.md5(f.read()).hexdigest()
+	finally:
+		f.close()
+
+
+class Md5CacheDBAPI(object):
+	""" A dbapi proxy reading IUSE, KEYWORDS and LICENSE straight
+		from the repository metadata/md5-cache. Falls back to the real
+		aux_get() whenever the cache entry is missing or stale. """
+
+	keys = frozenset(('IUSE', 'KEYWORDS', 'LICENSE'))
+
+	def __init__(self, dbapi, stats=None):
+		self._dbapi = dbapi
+		self._stats = stats
+		self._eclass_md5 = {}
+
+	def __getattr__(self, k):
+		return getattr(self._dbapi, k)
+
+	def _eclass_valid(self, repo, name, md5):
+		# eclasses can come from the repo itself or any of the masters
+		for r in [repo] + list(reversed(self._dbapi.porttrees)):
+			path = os.path.join(r, 'eclass', '%s.eclass' % name)
+			if path not in self._eclass_md5:
+				self._eclass_md5[path] = file_md5(path)
+			if self._eclass_md5[path] is not None:
+				return self._eclass_md5[path] == md5
+		return False
+
+	def _read(self, mycpv, myrepo):
+		ebuild, repo = self._dbapi.findname2(mycpv, myrepo=myrepo)
+		if ebuild is None:
+			return None
+
+		try:
+			f = open(os.path.join(repo, 'metadata', 'md5-cache', mycpv), 'rb')
+		except IOError:
+			return None
+
+		md = {}
+		try:
+			for l in f:
+				k, sep, v = l.decode('utf8').rstrip('\n').partition('=')
+				if k in self.keys or k in ('_md5_', '_eclasses_'):
+					md[k] = v
+		finally:
+			f.close()
+
+		if md.get('_md5_') != file_md5(ebuild):
+			return None
+		ecl = md.get('_eclasses_', '').split('\t')
+		for name, md5 in zip(ecl[0::2], ecl[1::2]):
+			if not self._eclass_valid(repo, name, md5):
+				return None
+
+		return md
+
+	def aux_get(self, mycpv, mylist, myrepo=None):
+		if self.keys.issuperset(mylist):
+			if myrepo is None:
+				myrepo = getattr(mycpv, 'repo', None)
+			md = self._read(mycpv, myrepo)
+			if md is not None:
+				if self._stats is not None:
+					self._stats.hit('md5-cache')
+				return [md.get(k, '') for k in mylist]
+			if self._stats is not None:
+				self._stats.miss('md5-cache')
+
+		if myrepo is not None:
+			return self._dbapi.aux_get(mycpv, mylist, myrepo=myrepo)
+		return self._dbapi.aux_get(mycpv, mylist)
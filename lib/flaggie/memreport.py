@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import ast
+import os.path
+import sys
+import tracemalloc
+
+import flaggie
+
+flaggie_dir = os.path.dirname(os.path.abspath(flaggie.__file__))
+
+
+def format_size(size):
+	for unit in ('B', 'KiB', 'MiB'):
+		if abs(size) < 1024:
+			return '%.1f %s' % (size, unit)
+		size /= 1024.0
+	return '%.1f GiB' % size
+
+
+def class_ranges(path):
+	""" Return a list of (first line, last line, qualified name)
+		for all classes defined in the Python source file path. """
+	try:
+		f = open(path, 'rb')
+	except IOError:
+		return []
+	try:
+		tree = ast.parse(f.read(), path)
+	except SyntaxError:
+		return []
+	finally:
+		f.close()
+
+	ret = []
+
+	def walk(node, prefix):
+		for n in ast.iter_child_nodes(node):
+			if isinstance(n, ast.ClassDef):
+				end = getattr(n, 'end_lineno', None)
+				if end is None:
+					end = max(getattr(x, 'lineno', n.lineno)
+							for x in ast.walk(n))
+				name = prefix + n.name
+				ret.append((n.lineno, end, name))
+				walk(n, name + '.')
+			else:
+				walk(n, prefix)
+
+	walk(tree, '')
+	return ret
+
+
+class MemoryReport(object):
+	""" tracemalloc-based memory usage report. Snapshots are taken
+		at the end of every phase, and the allocations are grouped
+		by the innermost flaggie module and class on the stack. """
+
+	def __init__(self, frames=16):
+		self.phases = []
+		self._groups = {}
+		self._classes = {}
+		tracemalloc.start(frames)
+
+	def _group(self, tb):
+		# since Python 3.7, frames are ordered from the oldest
+		if sys.version_info >= (3, 7):
+			tb = reversed(tb)
+		for fr in tb:
+			fn = os.path.abspath(fr.filename)
+			if os.path.dirname(fn) != flaggie_dir:
+				continue
+			mod = 'flaggie.' + os.path.splitext(os.path.basename(fn))[0]
+			if mod == 'flaggie.__init__':
+				mod = 'flaggie'
+
+			if fn not in self._classes:
+				self._classes[fn] = class_ranges(fn)
+			cls = None
+			for start, end, name in self._classes[fn]:
+				# the innermost (i.e. the last) class wins
+				if start <= fr.lineno <= end:
+					cls = name
+			return '%s.%s' % (mod, cls) if cls else mod
+		return '(outside flaggie)'
+
+	def _grouped(self, snapshot):
+		sizes = {}
+		for st in snapshot.statistics('traceback'):
+			if st.traceback not in self._groups:
+				self._groups[st.traceback] = self._group(st.traceback)
+			g = self._groups[st.traceback]
+			sizes[g] = sizes.get(g, 0) + st.size
+		return sizes
+
+	def phase(self, name):
+		""" Mark the end of the named phase. """
+		snapshot = tracemalloc.take_snapshot()
+		snapshot = snapshot.filter_traces((
+			tracemalloc.Filter(False, tracemalloc.__file__),
+			tracemalloc.Filter(False, __file__, all_frames=True),
+		))
+		current, peak = tracemalloc.get_traced_memory()
+		self.phases.append((name, current, peak, self._grouped(snapshot)))
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+
+	def stop(self):
+		tracemalloc.stop()
+
+	def report(self, output, limit=10):
+		output.write('Memory usage:\n')
+		if not self.phases:
+			output.write('\t(no phases recorded)\n')
+			return
+
+		prev = {}
+		for name, current, peak, sizes in self.phases:
+			output.write('\t%-24s current=%s peak=%s\n'
+					% (name, format_size(current), format_size(peak)))
+			growth = sorted(((v - prev.get(k, 0), k)
+					for k, v in sizes.items()), reverse=True)
+			for diff, g in growth[:limit]:
+				if diff <= 0:
+					break
+				output.write('\t\t%-40s +%s\n' % (g, format_size(diff)))
+			prev = sizes
+
+		output.write('Top allocators (at exit of %s):\n' % self.phases[-1][0])
+		sizes = self.phases[-1][3]
+		for g in sorted(sizes, key=lambda k: sizes[k], reverse=True)[:limit]:
+			output.write('\t%-40s %s\n' % (g, format_size(sizes[g])))
+		output.write('Peak traced memory: %s\n'
+				% format_size(max(x[2] for x in self.phases)))
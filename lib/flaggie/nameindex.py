@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import os
+import os.path
+
+from flaggie import diskcache
+
+INDEX_VERSION = 1
+
+
+def read_categories(repo):
+	try:
+		f = open(os.path.join(repo, 'profiles', 'categories'), 'r')
+	except IOError:
+		return []
+	try:
+		return [l.strip() for l in f
+				if l.strip() and not l.startswith('#')]
+	finally:
+		f.close()
+
+
+class PackageNameIndex(object):
+	""" Package name -> categories index over all repositories.
+		The index of every repository is persisted in the cache
+		directory, and considered fresh as long as the mtimes of
+		all its category directories are unchanged. Every repository
+		is scanned for the categories listed by any of them, since
+		overlays can use the categories of their masters. """
+
+	def __init__(self, repos):
+		self._repos = repos
+		self._index = None
+		self._categories = None
+
+	@property
+	def all_categories(self):
+		""" The sorted list of categories of all repositories. """
+		if self._categories is None:
+			cats = set()
+			for r in self._repos:
+				cats.update(read_categories(r))
+			self._categories = sorted(cats)
+		return self._categories
+
+	def _category_mtimes(self, repo):
+		mtimes = {}
+		for cat in self.all_categories:
+			try:
+				mtimes[cat] = os.stat(os.path.join(repo, cat)).st_mtime
+			except OSError:
+				pass
+		return mtimes
+
+	def _repo_index(self, repo):
+		mtimes = self._category_mtimes(repo)
+		name = diskcache.cache_name('names', os.path.realpath(repo))
+		data = diskcache.load(name)
+		if (data is not None and data.get('version') == INDEX_VERSION
+				and data.get('mtimes') == mtimes):
+			return data['names']
+
+		names = {}
+		for cat in sorted(mtimes):
+			catdir = os.path.join(repo, cat)
+			for pn in os.listdir(catdir):
+				if os.path.isdir(os.path.join(catdir, pn)):
+					names.setdefault(pn, []).append(cat)
+
+		diskcache.store(name, {
+			'version': INDEX_VERSION,
+			'mtimes': mtimes,
+			'names': names,
+		})
+		return names
+
+	@property
+	def index(self):
+		if self._index is None:
+			index = {}
+			for r in self._repos:
+				for pn, cats in self._repo_index(r).items():
+					index.setdefault(pn, set()).update(cats)
+			self._index = dict((k, tuple(sorted(v)))
+					for k, v in index.items())
+		return self._index
+
+	def categories(self, pn):
+		""" Return a sorted tuple of categories containing pn. """
+		return self.index.get(pn, ())
@@ -5,6 +5,7 @@
 
 import codecs
 import errno
+import fnmatch
 import itertools
 import os
 import os.path
@@ -12,18 +13,24 @@ import re
 import shutil
 import tempfile
 
-from portage import VERSION as portage_ver
-from portage.versions import vercmp
+from flaggie.complete import atom_cp
+from flaggie.lock import ConcurrentModification, FileLock, file_identity
 
 
 # comments start with '#' following whitespace
 comment_regexp = re.compile(r'\s#.*$')
+# the category part of an atom
+category_regexp = re.compile(r'^[<>=~!]*([^/]+)/')
 
 
 class InvalidPackageEntry(Exception):
 	pass
 
 
+class ShardingError(Exception):
+	pass
+
+
 class PackageFlagGroup(object):
 	def __init__(self, name):
 		self.name = name
@@ -95,6 +102,13 @@ class PackageFlag(object):
 
 
 class PackageEntry(object):
+	# implicit flags (e.g. the default keywords), shared between entries
+	# and read-only until the entry is materialized
+	implicit = ()
+	materialized = False
+	# line number in the file, if read from one
+	lineno = None
+
 	def __init__(self, l, whitespace=[]):
 		sl = l.split()
 		if not sl or sl[0].startswith('#'):  # whitespace
@@ -136,7 +150,16 @@ class PackageEntry(object):
 				self.trailing_whitespace)
 		return ret
 
+	def materialize(self):
+		""" Replace the implicit flags with explicit copies,
+			in order to modify them. """
+		if self.implicit:
+			self.flags.extend(PackageFlag(x.toString()) for x in self.implicit)
+			self.implicit = ()
+			self.materialized = True
+
 	def append(self, flag, group=None):
+		self.materialize()
 		if not isinstance(flag, PackageFlag):
 			if group is None:
 				flag = PackageFlag(flag)
@@ -154,7 +177,21 @@ class PackageEntry(object):
 		self.modified = True
 		return flag
 
+	def own(self, flag):
+		""" Return the modifiable flag: if flag is one of the implicit
+			flags, materialize them and return its copy. """
+		if self.implicit:
+			# implicit flags are set only on bare entries, so their
+			# copies are at the same positions
+			implicit = self.implicit
+			self.materialize()
+			for x, copy in zip(implicit, self.flags):
+				if x is flag:
+					return copy
+		return flag
+
 	def remove(self, flag):
+		flag = self.own(flag)
 		for g in self.flag_groups:
 			if flag in g:
 				g.remove(flag)
@@ -186,6 +223,8 @@ class PackageEntry(object):
 				yield sf
 		for f in reversed(self.flags):
 			yield f
+		for f in reversed(self.implicit):
+			yield f
 
 	def __getitem__(self, flag):
 		""" Iterate over occurences of flag in the entry,
@@ -196,10 +235,10 @@ class PackageEntry(object):
 
 	def __delitem__(self, flag):
 		""" Remove all occurences of a flag. """
-		flags = []
-		for f in self:
-			if flag == f.name:
-				flags.append(f)
+		flags = list(self[flag])
+		if flags and self.implicit:
+			self.materialize()
+			flags = list(self[flag])
 		for f in flags:
 			self.remove(f)
 
@@ -213,29 +252,221 @@ class PackageEntry(object):
 		return bool(self.flag_groups)
 
 
+class PendingReplace(object):
+	""" A replacement of the file at path with data, prepared
+		in a temporary file. commit() replaces the file atomically,
+		keeping the previous contents in path~ (unless backup
+		is False). Empty data removes the file (moving it to the backup
+		location). """
+
+	def __init__(self, path, data):
+		self.path = path
+		self._tmpname = None
+		if not data:
+			return
+
+		if not os.path.isdir(os.path.dirname(path)):
+			try:
+				os.makedirs(os.path.dirname(path))
+			except Exception:
+				pass
+		f = tempfile.NamedTemporaryFile('wb', delete=False,
+				dir=os.path.dirname(os.path.realpath(path)))
+
+		self._tmpname = f.name
+		try:
+			f = codecs.getwriter('utf8')(f)
+			f.write(data)
+			f.close()
+		except Exception:
+			os.unlink(self._tmpname)
+			raise
+
+	def commit(self, backup=True):
+		path = self.path
+		backup = path + '~' if backup else None
+		if self._tmpname is None:
+			try:
+				if backup is not None:
+					os.rename(path, backup)
+				else:
+					os.unlink(path)
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise
+			return
+
+		tmpname = self._tmpname
+		try:
+			try:
+				old_stat = os.stat(path)
+				if backup is not None:
+					os.rename(path, backup)
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise
+				old_stat = None
+			shutil.move(tmpname, path)
+		except Exception:
+			os.unlink(tmpname)
+			raise
+		finally:
+			self._tmpname = None
+
+		if old_stat is not None:
+			# TODO: ACLs?
+			os.chmod(path, old_stat.st_mode)
+			os.chown(path, old_stat.st_uid, old_stat.st_gid)
+		else:
+			# enforce user's umask (tempfile forces 0o77)
+			umask = os.umask(0o22)
+			os.umask(umask)
+			os.chmod(path, 0o666 & ~umask)
+
+	def abort(self):
+		if self._tmpname is not None:
+			os.unlink(self._tmpname)
+			self._tmpname = None
+
+
+class PendingWrite(object):
+	""" A prepared write of a PackageFile or a MakeConfFile (owner).
+		The owner needs to provide path, _identity (the identity
+		of the file when read) and _written(identity, data),
+		and _delta(data) for delta(). """
+
+	def __init__(self, owner, data):
+		self.owner = owner
+		self.path = owner.path
+		self._data = data
+		self._replace = PendingReplace(self.path, data)
+
+	def check(self):
+		if file_identity(self.path) != self.owner._identity:
+			raise ConcurrentModification(
+				'%s was modified by another process' % self.path)
+
+	def delta(self):
+		""" Return the journal ops for the write. Needs to be called
+			before commit(). """
+		return self.owner._delta(self._data)
+
+	def commit(self, backup=True):
+		self._replace.commit(backup)
+		self.owner._written(file_identity(self.path), self._data)
+
+	def abort(self):
+		self._replace.abort()
+
+
+class PendingDirectory(object):
+	""" A replacement of the file at path with a directory, for sharding
+		the file (owner is the PackageFile). The file is moved to path~
+		(always, since its contents are not journaled) and the directory
+		is created right away, so that the files inside it can be
+		prepared; abort() restores the file. """
+
+	def __init__(self, owner):
+		self.path = owner.path
+		with FileLock(self.path, exclusive=True):
+			if file_identity(self.path) != owner._identity:
+				raise ConcurrentModification(
+					'%s was modified by another process' % self.path)
+			os.rename(self.path, self.path + '~')
+			try:
+				os.mkdir(self.path)
+			except OSError:
+				os.rename(self.path + '~', self.path)
+				raise
+
+	def check(self):
+		pass
+
+	def delta(self):
+		return []
+
+	def commit(self, backup=True):
+		pass
+
+	def abort(self):
+		# the files inside need to be aborted first
+		os.rmdir(self.path)
+		os.rename(self.path + '~', self.path)
+
+
+def commit_writes(pending, backup=True):
+	""" Lock the files for all PendingWrites (in a fixed order, to avoid
+		deadlocks), verify that none of them was modified by another
+		process and replace them. If any of them was, all the writes
+		are aborted and ConcurrentModification is raised. If backup
+		is False, no path~ backups are made. """
+	pending = sorted(pending, key=lambda x: x.path)
+	locks = []
+	try:
+		try:
+			for p in pending:
+				l = FileLock(p.path, exclusive=True)
+				l.__enter__()
+				locks.append(l)
+			for p in pending:
+				p.check()
+		except Exception:
+			for p in reversed(pending):
+				p.abort()
+			raise
+
+		for p in pending:
+			p.commit(backup)
+	finally:
+		for l in reversed(locks):
+			l.__exit__(None, None, None)
+
+
+def file_changes(files):
+	""" Return (path, old lines, new lines, journal ops) for all
+		the modified files (PackageFiles or MakeConfFiles), without
+		writing anything. """
+	from flaggie.journal import split_lines
+
+	out = []
+	for f in files:
+		if f.modified:
+			data = f.data
+			out.append((f.path, f._lines, split_lines(data), f._delta(data)))
+	return out
+
+
 class PackageFile(list):
 	def __init__(self, path):
 		list.__init__(self)
 		self.path = path
 		# _modified is for when items are removed
 		self._modified = False
+		self._identity = None
+		# the lines as read, for journal deltas
+		self._lines = []
 		if not os.path.exists(path):
 			self.trailing_whitespace = []
 			return
-		f = codecs.open(path, 'r', 'utf8')
 
-		ws = []
-		for l in f:
-			try:
-				e = PackageEntry(l, ws)
-				ws = []
-			except InvalidPackageEntry:
-				ws.append(l)
-			else:
-				self.append(e)
+		with FileLock(path):
+			self._identity = file_identity(path)
+			f = codecs.open(path, 'r', 'utf8')
+
+			ws = []
+			for lineno, l in enumerate(f, 1):
+				self._lines.append(l)
+				try:
+					e = PackageEntry(l, ws)
+					ws = []
+				except InvalidPackageEntry:
+					ws.append(l)
+				else:
+					e.lineno = lineno
+					self.append(e)
 
-		self.trailing_whitespace = ws
-		f.close()
+			self.trailing_whitespace = ws
+			f.close()
 
 	def sort(self):
 		newlist = sorted(self)
@@ -265,69 +496,83 @@ class PackageFile(list):
 		data += ''.join(self.trailing_whitespace)
 		return data
 
-	def write(self):
+	def prepare(self):
+		""" Return a PendingWrite for the file, or None if it was
+			not modified. """
 		if not self.modified:
-			return
-
-		data = self.data
-
-		backup = self.path + '~'
-		if not data:
-			try:
-				os.rename(self.path, backup)
-			except OSError as e:
-				if e.errno != errno.ENOENT:
-					raise
-		else:
-			if not os.path.isdir(os.path.dirname(self.path)):
-				try:
-					os.makedirs(os.path.dirname(self.path))
-				except Exception:
-					pass
-			f = tempfile.NamedTemporaryFile('wb', delete=False,
-					dir=os.path.dirname(os.path.realpath(self.path)))
-
-			tmpname = f.name
-
-			try:
-				f = codecs.getwriter('utf8')(f)
-				f.write(data)
-				f.close()
-
-				try:
-					backup_stat = os.stat(self.path)
-					os.rename(self.path, backup)
-				except OSError as e:
-					if e.errno != errno.ENOENT:
-						raise
-					backup = None
-				shutil.move(tmpname, self.path)
-			except Exception:
-				os.unlink(tmpname)
-				raise
-
-			if backup is not None:
-				# TODO: ACLs?
-				os.chmod(self.path, backup_stat.st_mode)
-				os.chown(self.path, backup_stat.st_uid, backup_stat.st_gid)
-			else:
-				# enforce user's umask (tempfile forces 0o77)
-				umask = os.umask(0o22)
-				os.umask(umask)
-				os.chmod(self.path, 0o666 & ~umask)
-
+			return None
+		return PendingWrite(self, self.data)
+
+	def _delta(self, data):
+		""" Compute the journal ops for the new data. The entries
+			that were not modified are matched against their lines
+			in the old file, and only the lines between them are
+			compared. """
+		from flaggie.journal import diff_lines, split_lines
+
+		old = self._lines
+		new = split_lines(data)
+		# (old start, new start, length) of unchanged spans
+		anchors = []
+		pos = 0
+		for e in self:
+			n = len(e.whitespace) + 1
+			if e.lineno is not None and not e.modified:
+				start = e.lineno - n
+				if (start >= 0 and old[start:e.lineno] == new[pos:pos + n]
+						and (not anchors or start >= anchors[-1][0] + anchors[-1][2])):
+					anchors.append((start, pos, n))
+			pos += n
+		anchors.append((len(old), len(new), 0))
+
+		ops = []
+		i = j = 0
+		for start, pos, n in anchors:
+			if i != start or j != pos:
+				ops.extend([i + x[0], j + x[1], x[2], x[3]]
+						for x in diff_lines(old[i:start], new[j:pos]))
+			i = start + n
+			j = pos + n
+		return ops
+
+	def _written(self, identity, data):
+		from flaggie.journal import split_lines
+
+		self._identity = identity
+		self._lines = split_lines(data)
+		lineno = 0
 		for e in self:
-			e.modified = False
+			lineno += len(e.whitespace) + 1
+			e.lineno = lineno
+			if e.modified:
+				e.as_str = e.toString()[len(''.join(e.whitespace)):]
+				e.modified = False
 		self.modified = False
 
+	def write(self):
+		p = self.prepare()
+		if p is not None:
+			commit_writes([p])
+
 
 class PackageFileSet(object):
-	def __init__(self, path):
+	def __init__(self, path, globals=None, sharded=False, preloaded=None):
 		if not isinstance(path, tuple) and not isinstance(path, list):
 			path = (path,)
 
 		self._paths = path
 		self._files = []
+		# files read in advance by preload_files()
+		self._preloaded = preloaded
+		# global (make.conf) counterpart, used for pkg=None
+		self._globals = globals
+		# route new entries into per-category files
+		self._sharded = sharded
+		# set when shard() turned the final path into a directory
+		self._shard_dir = False
+		# the final path PackageFile, if it is to be replaced
+		# by a directory
+		self._convert = None
 
 	@property
 	def files(self):
@@ -357,12 +602,153 @@ class PackageFileSet(object):
 
 		lf.modified = True
 
+	def _shard_path(self, pkg):
+		if isinstance(pkg, PackageEntry):
+			pkg = pkg.package
+		m = category_regexp.match(pkg)
+		if m is None:
+			return None
+		for c in ('*', '?', '['):
+			if c in m.group(1):
+				return None
+		return os.path.join(self._paths[-1], m.group(1))
+
+	def _overridden(self, path, pkg):
+		""" Check whether an entry in a file read after path may match
+			pkg (and therefore override an entry for it in path).
+			The entries are compared by their cp, which may contain
+			wildcards. """
+		if isinstance(pkg, PackageEntry):
+			pkg = pkg.package
+		cp = atom_cp(pkg)
+		prefix = self._paths[-1] + os.sep
+		for f in self.files:
+			if not f.path.startswith(prefix) or f.path <= path:
+				continue
+			for pe in f:
+				pat = re.split(r'[:\[]', pe.package.lstrip('<>=~!'), 1)[0]
+				if (fnmatch.fnmatchcase(cp, pat)
+						or fnmatch.fnmatchcase(cp, atom_cp(pe.package))):
+					return True
+		return False
+
+	def _get_shard(self, path):
+		for f in self.files:
+			if f.path == path:
+				return f
+
+		# keep the files in the directory sorted
+		prefix = self._paths[-1] + os.sep
+		idx = len(self._files)
+		for i, f in enumerate(self._files):
+			if f.path.startswith(prefix):
+				idx = i
+				if f.path > path:
+					break
+				idx += 1
+		f = PackageFile(path)
+		self._files.insert(idx, f)
+		return f
+
+	def _wildcard_shard(self, leading, trailing):
+		""" Return the path to the file for wildcard entries moved out
+			of the final path: '00-flaggie' (sorted before the categories)
+			for the entries preceding all the others, 'zz-flaggie' (sorted
+			after them) for the ones following all the others,
+			and 'flaggie' otherwise. """
+		if leading:
+			fn = '00-flaggie'
+		elif trailing:
+			fn = 'zz-flaggie'
+		else:
+			fn = 'flaggie'
+		return os.path.join(self._paths[-1], fn)
+
+	def shard(self):
+		""" Split the entries of the final path into per-category
+			files inside the directory. If the final path is a file,
+			it is replaced by a directory (when writing), and the entries
+			with wildcard categories go into the flaggie files inside it
+			(see _wildcard_shard()). Otherwise, such entries are left
+			in place.
+
+			The files are filled with the entries in their order
+			of effectiveness. If the order in which the files are read
+			would make a wildcard entry change places with any other
+			entry, ShardingError is raised and nothing is changed. """
+
+		lp = self._paths[-1]
+		convert = os.path.isfile(lp)
+		files = [f for f in self.files
+				if f.path == lp or f.path.startswith(lp + os.sep)]
+
+		entries = [pe for f in files for pe in f]
+		owners = [f.path for f in files for pe in f]
+		categorized = [i for i, pe in enumerate(entries)
+				if self._shard_path(pe) is not None]
+		targets = []
+		for i, pe in enumerate(entries):
+			path = self._shard_path(pe)
+			if path is None:
+				if convert:
+					path = self._wildcard_shard(
+						not categorized or i < categorized[0],
+						bool(categorized) and i > categorized[-1])
+				else:
+					path = owners[i]
+			targets.append(path)
+
+		# the files are read in the sorted order, so that is
+		# the new position of every entry
+		rank = dict((p, i) for i, p in enumerate(sorted(set(targets))))
+		newpos = [(rank[t], i) for i, t in enumerate(targets)]
+		# wildcard entries can affect any package, so no entry can
+		# move across them
+		pmax = []
+		for x in newpos:
+			pmax.append(max(pmax[-1], x) if pmax else x)
+		smin = []
+		for x in reversed(newpos):
+			smin.append(min(smin[-1], x) if smin else x)
+		smin.reverse()
+		for i, pe in enumerate(entries):
+			if self._shard_path(pe) is not None:
+				continue
+			if ((i > 0 and pmax[i - 1] > newpos[i])
+					or (i + 1 < len(entries) and smin[i + 1] < newpos[i])):
+				raise ShardingError('%s: unable to shard without changing'
+					' the order of %s' % (lp, pe.package))
+
+		old = dict((f.path, list(f)) for f in files)
+		for f in files:
+			del f[:]
+		for pe, path in zip(entries, targets):
+			self._get_shard(path).append(pe)
+		for f in self._files:
+			if [id(x) for x in f] != [id(x) for x in old.get(f.path, ())]:
+				f.modified = True
+
+		if convert:
+			f = files[0]
+			if f.trailing_whitespace:
+				catchall = self._get_shard(self._wildcard_shard(False, True))
+				catchall.trailing_whitespace = f.trailing_whitespace
+				catchall.modified = True
+			self._files.remove(f)
+			self._convert = f
+		self._shard_dir = True
+
 	def read(self):
 		if self._files:
 			return
+		if self._preloaded:
+			self._files = self._preloaded
+			self._preloaded = None
+			return
 
 		for fn in self._paths:
-			if os.path.isdir(fn):
+			if os.path.isdir(fn) or (self._sharded
+					and fn == self._paths[-1] and not os.path.exists(fn)):
 				files = []
 				for toppath, wdirs, wfiles in os.walk(fn):
 					for f in wfiles:
@@ -380,17 +766,71 @@ class PackageFileSet(object):
 			for path in files:
 				self._files.append(PackageFile(path))
 
+	def _finalize(self):
+		""" Fix up the entries before writing. """
+		pass
+
+	def prepare(self):
+		""" Return a list of PendingWrites for all modified files
+			(excluding the globals). """
+		if not self._files:
+			return []
+
+		self._finalize()
+		pending = []
+		try:
+			if self._convert is not None:
+				# needs to be done before preparing the files inside
+				pending.append(PendingDirectory(self._convert))
+			for f in self._files:
+				p = f.prepare()
+				if p is not None:
+					pending.append(p)
+		except Exception:
+			for p in reversed(pending):
+				p.abort()
+			raise
+		return pending
+
+	def changes(self):
+		""" Return the changes to the files (excluding the globals),
+			see file_changes(). """
+		from flaggie.journal import diff_lines
+
+		if not self._files:
+			return []
+
+		self._finalize()
+		out = []
+		if self._convert is not None:
+			# the file is replaced by the directory
+			f = self._convert
+			out.append((f.path, f._lines, [], diff_lines(f._lines, [])))
+		return out + file_changes(self._files)
+
 	def write(self):
+		if self._globals is not None:
+			self._globals.write()
 		if not self._files:
 			return
 
-		for f in self._files:
-			f.write()
-			del f
+		commit_writes(self.prepare())
 		self._files = []
+		self._convert = None
 
 	def append(self, pkg):
+		if pkg is None:
+			if self._globals is None:
+				raise NotImplementedError(
+					'Global var manipulations not supported for %s' % self._paths[0])
+			return self._globals.append()
+
 		f = self.files[-1]
+		if self._sharded and (self._shard_dir
+				or not os.path.isfile(self._paths[-1])):
+			path = self._shard_path(pkg)
+			if path is not None and not self._overridden(path, pkg):
+				f = self._get_shard(path)
 		if not isinstance(pkg, PackageEntry):
 			pkg = PackageEntry(pkg)
 		pkg.modified = True
@@ -427,8 +867,12 @@ class PackageFileSet(object):
 		"""
 
 		if pkg is None:
-			raise NotImplementedError(
-				'Global var manipulations temporarily removed')
+			if self._globals is None:
+				raise NotImplementedError(
+					'Global var manipulations not supported for %s' % self._paths[0])
+			for e in self._globals:
+				yield e
+			return
 
 		for e in self:
 			if pkg == e.package:
@@ -447,12 +891,16 @@ class PackageFileSet(object):
 
 
 class PackageKeywordsFileSet(PackageFileSet):
-	def __init__(self, path, dbapi):
-		PackageFileSet.__init__(self, path)
+	def __init__(self, path, dbapi, settings=None, globals=None,
+			sharded=False, preloaded=None):
+		PackageFileSet.__init__(self, path, globals, sharded, preloaded)
 
+		if settings is None:
+			settings = dbapi.settings
 		self._defkw = frozenset('~' + x for x
-			in dbapi.settings['ACCEPT_KEYWORDS'].split()
+			in settings['ACCEPT_KEYWORDS'].split()
 			if x[0] not in ('~', '-'))
+		self._implicit = tuple(PackageFlag(x) for x in sorted(self._defkw))
 
 	def read(self, *args):
 		if self._files:
@@ -460,57 +908,105 @@ class PackageKeywordsFileSet(PackageFileSet):
 
 		PackageFileSet.read(*((self,) + args))
 
-		# set defaults
+		# bare entries imply the default keywords
 		for e in self:
-			if not e:
-				for f in self._defkw:
-					e.append(f)
-				e.modified = False
+			if not e.flags and not e.flag_groups:
+				e.implicit = self._implicit
 
-	def write(self, *args):
-		if not self._files:
-			return
-
-		for f in self.files:
+	def _finalize(self):
+		for f in self._files:
 			for e in f:
-				if e.modified and set(x.toString() for x in e.flags) == self._defkw:
-					# Yeah, that's what it looks like -- a workaround.
-					e.as_str = e.package + '\n'
+				if not (e.modified and e.materialized and not e.flag_groups):
+					continue
+				flags = set(x.toString() for x in e.flags)
+				# a bare entry again (even if the implicit keywords were
+				# removed, a bare entry means exactly the same)
+				if not flags or flags == self._defkw:
 					e.modified = False
-					f.modified = True
-
-		PackageFileSet.write(*((self,) + args))
+					if e.lineno is None:
+						# a new entry, otherwise the original line is kept
+						e.as_str = e.package + '\n'
+						f.modified = True
 
 
 class PackageEnvFileSet(PackageFileSet):
-	def write(self, *args):
-		if not self._files:
-			return
-
-		for f in self.files:
+	def _finalize(self):
+		for f in self._files:
 			for e in f:
 				if e.modified:
 					rlist = [fl for fl in e if fl.modifier == '-']
 					for fl in rlist:
 						e.remove(fl)
 
-		PackageFileSet.write(*((self,) + args))
+
+# the file sets read by PackageFiles, relative to the config directory
+package_file_sets = (
+	('package.use',),
+	('package.keywords', 'package.accept_keywords'),
+	('package.license',),
+	('package.env',),
+)
+
+
+def preload_files(basedir, sharded=False):
+	""" Read all package.* files (and warm the make.conf cache) in
+		basedir, without needing portage. This is meant to be run
+		in a background thread while the portage trees are being set
+		up. Returns a dict to be passed to PackageFiles as preloaded. """
+	from flaggie.makeconf import MakeConf
+
+	MakeConf([os.path.join(os.path.dirname(basedir), 'make.conf'),
+		os.path.join(basedir, 'make.conf')]).files
+
+	out = {}
+	for paths in package_file_sets:
+		paths = tuple(os.path.join(basedir, x) for x in paths)
+		fs = PackageFileSet(paths, sharded=sharded)
+		fs.read()
+		out[paths] = fs._files
+	return out
 
 
 class PackageFiles(object):
-	def __init__(self, basedir, dbapi):
+	def __init__(self, basedir, dbapi, settings=None, sharded=False,
+			preloaded=None, journal=None):
+		from portage import VERSION as portage_ver
+		from portage.versions import vercmp
+
+		from flaggie.makeconf import MakeConf, MakeConfVarSet
+
 		def p(x):
 			return os.path.join(basedir, x)
 
+		def pre(*paths):
+			if preloaded is None:
+				return None
+			return preloaded.get(tuple(paths))
+
+		if settings is None:
+			settings = dbapi.settings
+		self._journal = journal
+
 		pkw = [p('package.keywords')]
 		if vercmp(portage_ver, '2.1.9') >= 0:
 			pkw.append(p('package.accept_keywords'))
 
+		use_expand = settings.get('USE_EXPAND', '').split()
+		self._makeconf = makeconf = MakeConf([os.path.join(os.path.dirname(basedir), 'make.conf'),
+			p('make.conf')], use_expand)
+
 		self.files = {
-			'use': PackageFileSet(p('package.use')),
-			'kw': PackageKeywordsFileSet(pkw, dbapi),
-			'lic': PackageFileSet(p('package.license')),
-			'env': PackageEnvFileSet(p('package.env'))
+			'use': PackageFileSet(p('package.use'),
+				MakeConfVarSet(makeconf, ['USE'] + use_expand, 'USE'),
+				sharded, pre(p('package.use'))),
+			'kw': PackageKeywordsFileSet(pkw, dbapi, settings,
+				MakeConfVarSet(makeconf, ['ACCEPT_KEYWORDS'], 'ACCEPT_KEYWORDS'),
+				sharded, pre(*pkw)),
+			'lic': PackageFileSet(p('package.license'),
+				MakeConfVarSet(makeconf, ['ACCEPT_LICENSE'], 'ACCEPT_LICENSE'),
+				sharded, pre(p('package.license'))),
+			'env': PackageEnvFileSet(p('package.env'), sharded=sharded,
+				preloaded=pre(p('package.env')))
 		}
 
 	def __getitem__(self, k):
@@ -519,6 +1015,72 @@ class PackageFiles(object):
 	def __iter__(self):
 		return iter(self.files.values())
 
+	def changes(self):
+		""" Return the changes to all the files, see file_changes(). """
+		out = []
+		for k in sorted(self.files):
+			out.extend(self.files[k].changes())
+		out.extend(self._makeconf.changes())
+		return out
+
+	def subset(self, ns):
+		""" Return a view of the files restricted to namespace ns. """
+		return PackageFilesSubset(self, ns)
+
 	def write(self):
+		""" Write all the modified files. The new contents are prepared
+			for every namespace (and make.conf) in parallel, and the files
+			are replaced only if all of them succeeded, and none of them
+			was modified by another process meanwhile.
+
+			With a journal, the changes are recorded in it instead
+			of keeping path~ backups. """
+		from flaggie.pipeline import ParallelError, run_parallel
+
+		tasks = [(k, self.files[k].prepare) for k in sorted(self.files)]
+		tasks.append(('make.conf', self._makeconf.prepare))
+
+		pending = []
+		errors = []
+		for k, res, exc in run_parallel(tasks):
+			if exc is not None:
+				errors.append((k, exc))
+			else:
+				pending.extend(res)
+
+		if errors:
+			for p in reversed(pending):
+				p.abort()
+			if len(errors) == 1:
+				raise errors[0][1]
+			if all(isinstance(e, ConcurrentModification) for k, e in errors):
+				# keep it retryable
+				raise ConcurrentModification('; '.join(str(e)
+					for k, e in errors))
+			raise ParallelError(errors)
+
+		if self._journal is not None:
+			changes = [(p.path, p.delta()) for p in pending]
+			with self._journal:
+				commit_writes(pending, backup=False)
+				self._journal.record(changes)
+		else:
+			commit_writes(pending)
 		for f in self:
-			f.write()
+			f._files = []
+			f._convert = None
+		self._makeconf._files = []
+
+
+class PackageFilesSubset(object):
+	""" A view of PackageFiles restricted to a single namespace,
+		used to apply the actions for every namespace separately. """
+
+	def __init__(self, pfiles, ns):
+		self.files = {ns: pfiles[ns]}
+
+	def __getitem__(self, k):
+		return self.files[k]
+
+	def __iter__(self):
+		return iter(self.files.values())
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import sys
+import threading
+
+
+class Task(object):
+	""" Run func(*args) in a background thread. The result (or the
+		exception raised) is obtained via result(), which waits
+		for the thread to finish. """
+
+	def __init__(self, func, *args):
+		self._result = None
+		self._exc = None
+		self._thread = threading.Thread(target=self._run, args=(func, args))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self, func, args):
+		try:
+			self._result = func(*args)
+		except Exception:
+			self._exc = sys.exc_info()[1]
+
+	def result(self):
+		self._thread.join()
+		if self._exc is not None:
+			raise self._exc
+		return self._result
+
+
+class ParallelError(Exception):
+	""" Raised when more than one of the parallel tasks failed.
+		errors lists the (key, exception) pairs, in the order
+		of the tasks. """
+
+	def __init__(self, errors):
+		self.errors = errors
+		Exception.__init__(self, '; '.join('%s: %s' % (k, e)
+			for k, e in errors))
+
+
+def run_parallel(tasks):
+	""" Run the (key, func) tasks in parallel threads and wait for all
+		of them to finish. Returns a list of (key, result, exception)
+		tuples, in the order of tasks. """
+	running = [(k, Task(func)) for k, func in tasks]
+	out = []
+	for k, t in running:
+		try:
+			out.append((k, t.result(), None))
+		except Exception as e:
+			out.append((k, None, e))
+	return out
+
+
+def check_results(results):
+	""" Raise the error from run_parallel() results, if any. If more
+		than one task failed, raise ParallelError. """
+	errors = [(k, e) for k, r, e in results if e is not None]
+	if len(errors) == 1:
+		raise errors[0][1]
+	elif errors:
+		raise ParallelError(errors)
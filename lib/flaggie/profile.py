@@ -0,0 +1,373 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import codecs
+import fnmatch
+import itertools
+import os
+import os.path
+
+from flaggie import diskcache
+from flaggie.makeconf import parse_makeconf
+
+STACK_VERSION = 2
+
+# files (or directories) read from every profile
+profile_files = ('parent', 'make.defaults', 'use.force', 'use.mask',
+		'package.use', 'package.use.force', 'package.use.mask')
+
+
+def read_lines(path):
+	""" Read the non-comment lines of path, which can be either a file
+		or a directory of files (read in lexical order). """
+	if os.path.isdir(path):
+		out = []
+		for fn in sorted(os.listdir(path)):
+			if not fn.startswith('.') and not fn.endswith('~'):
+				out.extend(read_lines(os.path.join(path, fn)))
+		return out
+
+	try:
+		f = codecs.open(path, 'r', 'utf8')
+	except IOError:
+		return []
+	try:
+		out = []
+		for l in f:
+			l = l.split('#', 1)[0].strip()
+			if l:
+				out.append(l)
+		return out
+	finally:
+		f.close()
+
+
+def repo_names(repos):
+	names = {}
+	for r in repos:
+		for n in read_lines(os.path.join(r, 'profiles', 'repo_name')):
+			names[n] = r
+			break
+	return names
+
+
+def profile_dirs(config_root, repos):
+	""" Return the profile stack for config_root, starting with
+		the least specific profile and ending with the user profile
+		(/etc/portage/profile) if it exists. """
+
+	names = repo_names(repos)
+
+	def walk(d, depth=0):
+		if depth > 32:
+			raise ValueError('Profile parent loop in %s' % d)
+		out = []
+		for l in read_lines(os.path.join(d, 'parent')):
+			if ':' in l and not l.startswith('/'):
+				repo, p = l.split(':', 1)
+				if repo not in names:
+					continue
+				p = os.path.join(names[repo], 'profiles', p)
+			else:
+				p = os.path.join(d, l)
+			out.extend(walk(os.path.normpath(p), depth + 1))
+		out.append(d)
+		return out
+
+	out = []
+	for p in (os.path.join(config_root, 'etc', 'portage', 'make.profile'),
+			os.path.join(config_root, 'etc', 'make.profile')):
+		if os.path.isdir(p):
+			out = walk(os.path.realpath(p))
+			break
+
+	userprof = os.path.join(config_root, 'etc', 'portage', 'profile')
+	if os.path.isdir(userprof):
+		out.append(userprof)
+	return out
+
+
+def incremental(s, tokens):
+	""" Apply incremental tokens (flag, -flag, -*, and -prefix_*
+		clearing the flags of a USE_EXPAND variable) to the set s. """
+	for t in tokens:
+		if t == '-*':
+			s.clear()
+		elif t.startswith('-') and t.endswith('_*'):
+			pfx = t[1:-1]
+			for x in [x for x in s if x.startswith(pfx)]:
+				s.discard(x)
+		elif t.startswith('-'):
+			s.discard(t[1:])
+		else:
+			s.add(t.lstrip('+'))
+
+
+class ProfileStack(object):
+	""" The USE-related parts of a profile stack, flattened into
+		a list of levels per variable ('use', 'force', 'mask'). Every
+		level is a pair of a list of global tokens and a dict mapping
+		cp to (atom, tokens) pairs, so that the package-specific
+		entries are applied in the same order as portage does.
+
+		The flattened stack is kept in the cache directory, and reused
+		as long as the mtimes of all the profile files are unchanged. """
+
+	def __init__(self, config_root, dirs, use_expand=()):
+		self.dirs = dirs
+		self.use_expand = sorted(use_expand)
+		self.levels = None
+
+		mtimes = self._mtimes()
+		name = diskcache.cache_name('profile', os.path.realpath(config_root))
+		data = diskcache.load(name)
+		if (data is not None and data.get('version') == STACK_VERSION
+				and data.get('dirs') == dirs
+				and data.get('use_expand') == self.use_expand
+				and data.get('mtimes') == mtimes):
+			self.levels = data['levels']
+		else:
+			self.levels = self._flatten()
+			diskcache.store(name, {
+				'version': STACK_VERSION,
+				'dirs': dirs,
+				'use_expand': self.use_expand,
+				'mtimes': mtimes,
+				'levels': self.levels,
+			})
+
+	def _mtimes(self):
+		mtimes = {}
+		for d in self.dirs:
+			for fn in profile_files:
+				path = os.path.join(d, fn)
+				try:
+					mtimes[path] = os.stat(path).st_mtime
+				except OSError:
+					continue
+				if os.path.isdir(path):
+					for sfn in os.listdir(path):
+						sp = os.path.join(path, sfn)
+						mtimes[sp] = os.stat(sp).st_mtime
+		return mtimes
+
+	def _make_defaults(self, d):
+		path = os.path.join(d, 'make.defaults')
+		try:
+			f = codecs.open(path, 'r', 'utf8')
+		except IOError:
+			return []
+		try:
+			segs = parse_makeconf(f.read())
+		finally:
+			f.close()
+
+		tokens = []
+		for s in segs:
+			if not isinstance(s, tuple):
+				continue
+			var, prefix, value, suffix, quote = s
+			if var == 'USE':
+				pfx = ''
+			elif var in self.use_expand:
+				pfx = '%s_' % var.lower()
+			else:
+				continue
+			for x in value.replace('\\\n', ' ').split():
+				if x.startswith('$'):
+					continue
+				elif x == '-*' and pfx:
+					# reset only the flags of the USE_EXPAND variable
+					tokens.append('-%s*' % pfx)
+				elif x.startswith('-'):
+					tokens.append('-' + pfx + x[1:])
+				else:
+					tokens.append(pfx + x.lstrip('+'))
+		return tokens
+
+	def _package_file(self, path):
+		from portage.dep import Atom
+		from portage.exception import InvalidAtom
+
+		out = {}
+		for l in read_lines(path):
+			sl = l.split()
+			try:
+				cp = Atom(sl[0]).cp
+			except InvalidAtom:
+				continue
+			if cp not in out:
+				out[cp] = []
+			out[cp].append((sl[0], sl[1:]))
+		return out
+
+	def _flatten(self):
+		levels = {'use': [], 'force': [], 'mask': []}
+		for d in self.dirs:
+			for k, glob, pkg in (
+					('use', None, 'package.use'),
+					('force', 'use.force', 'package.use.force'),
+					('mask', 'use.mask', 'package.use.mask')):
+				if glob is None:
+					tokens = self._make_defaults(d)
+				else:
+					tokens = read_lines(os.path.join(d, glob))
+				pkgs = self._package_file(os.path.join(d, pkg))
+
+				l = levels[k]
+				if not pkgs and l and not l[-1][1]:
+					# merge into the previous level if there is
+					# nothing package-specific in between
+					l[-1][0].extend(tokens)
+				elif tokens or pkgs:
+					l.append((tokens, pkgs))
+		return levels
+
+	def apply(self, s, k, cpv=None, match=None):
+		""" Apply the stack for variable k ('use', 'force' or 'mask')
+			to the set s. If cpv is not None, the package-specific
+			entries for it are included too; match(atom) needs to return
+			the packages matching atom then. """
+		from portage.versions import cpv_getkey
+
+		cp = cpv_getkey(cpv) if cpv is not None else None
+		for tokens, pkgs in self.levels[k]:
+			incremental(s, tokens)
+			if cp is not None:
+				for atom, ptokens in pkgs.get(cp, ()):
+					if cpv in (match(atom) or ()):
+						incremental(s, ptokens)
+
+
+class EffectiveFlag(object):
+	""" The effective state of a flag. Forced and masked flags
+		are output as (+flag) and (-flag) respectively. """
+
+	def __init__(self, name, enabled, fixed=False):
+		self.name = name
+		self.enabled = enabled
+		self.fixed = fixed
+
+	@property
+	def modifier(self):
+		return '' if self.enabled else '-'
+
+	def toString(self):
+		if self.fixed:
+			return '(%s%s)' % ('+' if self.enabled else '-', self.name)
+		return '%s%s' % (self.modifier, self.name)
+
+
+class EffectiveUse(object):
+	""" Effective USE flags, combining IUSE defaults, the profile
+		stack, make.conf and package.use (in the portage order). """
+
+	def __init__(self, stack, dbapi, resolver):
+		self._stack = stack
+		self._dbapi = dbapi
+		self._resolver = resolver
+		self._entries = None
+		self._index = None
+
+	def _index_entries(self, pfile):
+		""" Index the entries of pfile by cp, as lists of (position,
+			entry) pairs in the file order. The entries with wildcard
+			atoms are stored under None, as (position, atom, entry)
+			triplets. The index is rebuilt only if the entries
+			change. """
+		from portage.dep import Atom
+		from portage.exception import InvalidAtom
+
+		entries = list(itertools.chain.from_iterable(pfile.files))
+		if entries == self._entries:
+			return self._index
+
+		index = {None: []}
+		for i, e in enumerate(entries):
+			try:
+				try:
+					a = Atom(e.package, allow_wildcard=True)
+				except TypeError:
+					a = Atom(e.package)
+			except InvalidAtom:
+				continue
+			if '*' in a.cp:
+				index[None].append((i, a, e))
+			else:
+				index.setdefault(a.cp, []).append((i, e))
+
+		self._entries = entries
+		self._index = index
+		return index
+
+	def _user_tokens(self, cpv, pfile):
+		from portage.dep import match_from_list
+		from portage.versions import cpv_getkey
+
+		tokens = []
+		# entries are iterated in order of effectiveness, so reverse
+		for e in reversed(list(pfile[None])):
+			tokens.extend(f.toString() for f in reversed(list(e)))
+		if cpv is not None:
+			cp = cpv_getkey(cpv)
+			index = self._index_entries(pfile)
+			found = [(i, e) for i, e in index.get(cp, ())
+					if cpv in (self._resolver.match_all(e.package) or ())]
+			for i, a, e in index[None]:
+				if (fnmatch.fnmatchcase(cp, a.cp)
+						and (a == a.cp or match_from_list(a, [cpv]))):
+					found.append((i, e))
+			for i, e in sorted(found, key=lambda x: x[0]):
+				tokens.extend(f.toString() for f in reversed(list(e)))
+		return tokens
+
+	def query(self, pkg, pfile):
+		""" Return a dict mapping flag names to EffectiveFlags for
+			the best match of pkg (or the global state if pkg is None),
+			using package.use file set pfile. """
+		match = self._resolver.match_all
+		if pkg is not None:
+			cpv = self._resolver.best(pkg)
+			if cpv is None:
+				return {}
+			iuse = self._dbapi.aux_get(cpv, ('IUSE',))[0].split()
+			names = set(x.lstrip('+-') for x in iuse)
+			enabled = set(x[1:] for x in iuse if x.startswith('+'))
+		else:
+			cpv = None
+			names = None
+			enabled = set()
+
+		user = self._user_tokens(cpv, pfile)
+		self._stack.apply(enabled, 'use', cpv, match)
+		incremental(enabled, user)
+		force = set()
+		self._stack.apply(force, 'force', cpv, match)
+		mask = set()
+		self._stack.apply(mask, 'mask', cpv, match)
+
+		if names is None:
+			names = enabled | force | mask
+			names.update(x[1:] for x in user if x.startswith('-'))
+			names.discard('*')
+
+		ret = {}
+		for n in names:
+			if n in mask:
+				ret[n] = EffectiveFlag(n, False, True)
+			elif n in force:
+				ret[n] = EffectiveFlag(n, True, True)
+			else:
+				ret[n] = EffectiveFlag(n, n in enabled)
+		return ret
+
+
+def load_profile(dbapi, resolver):
+	""" Create EffectiveUse for the configuration of dbapi. """
+	settings = dbapi.settings
+	confroot = settings['PORTAGE_CONFIGROOT']
+	stack = ProfileStack(confroot, profile_dirs(confroot, dbapi.porttrees),
+			settings.get('USE_EXPAND', '').split())
+	return EffectiveUse(stack, dbapi, resolver)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+from flaggie.action import ParserError, Pattern
+
+
+class FlagOccurence(object):
+	""" A single occurence of a flag in package.* or make.conf. """
+
+	def __init__(self, ns, entry, flag, path, effective):
+		self.ns = ns
+		self.package = entry.package
+		self.var = getattr(entry, 'var', None)
+		self.flag = flag
+		self.path = path
+		self.lineno = entry.lineno
+		self.effective = effective
+
+	@property
+	def modifier(self):
+		return self.flag.modifier
+
+	def toString(self):
+		loc = self.path
+		if self.lineno is not None:
+			loc = '%s:%d' % (loc, self.lineno)
+		ret = '%s: %s %s' % (loc,
+				self.package if self.package is not None else self.var,
+				self.flag.toString())
+		if not self.effective:
+			ret += ' (ineffective)'
+		return ret
+
+
+def located_entries(fileset):
+	""" Iterate over (path, entry) for a PackageFileSet, in the order
+		of effectiveness, followed by the global (make.conf) entries. """
+	for f in reversed(fileset.files):
+		for e in reversed(f):
+			yield (f.path, e)
+	try:
+		for e in fileset[None]:
+			yield (e.path, e)
+	except NotImplementedError:
+		pass
+
+
+class ReverseIndex(object):
+	""" Flag name -> occurences index for a PackageFileSet, built
+		in a single pass. Flags in USE_EXPAND groups are indexed
+		by their full names (e.g. video_cards_intel). An occurence
+		is effective if it is the first one for the package (or
+		the global variable) in the order of effectiveness. """
+
+	def __init__(self, ns, fileset):
+		self.ns = ns
+		self._index = {}
+		seen = set()
+		for path, e in located_entries(fileset):
+			key = e.package if e.package is not None else (None, e.var)
+			for f in e:
+				k = (key, f.name)
+				if f.name not in self._index:
+					self._index[f.name] = []
+				self._index[f.name].append(
+						FlagOccurence(ns, e, f, path, k not in seen))
+				seen.add(k)
+
+	def lookup(self, arg, modifier=None):
+		""" Iterate over occurences of arg (a flag name or a Pattern).
+			If modifier is '-', only disabled flags are returned,
+			if it is '+', only enabled ones. """
+		if isinstance(arg, Pattern):
+			names = sorted(k for k in self._index if arg == k)
+		else:
+			names = (arg,)
+
+		for n in names:
+			for o in self._index.get(n, ()):
+				if modifier == '-' and o.modifier != '-':
+					continue
+				elif modifier == '+' and o.modifier == '-':
+					continue
+				yield o
+
+
+def parse_query(arg, namespaces):
+	""" Parse a --find argument into a (namespaces, arg, modifier)
+		tuple. The argument can be prefixed with a modifier ('+'
+		or '-') and a namespace ('use::'), and can be a wildcard. """
+	modifier = None
+	if arg[:1] in ('+', '-'):
+		modifier = arg[0]
+		arg = arg[1:]
+
+	splitarg = arg.split('::', 1)
+	if len(splitarg) > 1:
+		nsarg = Pattern(splitarg[0])
+		arg = splitarg[1]
+		ns = [k for k in namespaces if nsarg == k]
+		if not ns:
+			raise ParserError('Namespace not matched: %s' % splitarg[0])
+		explicit_ns = True
+	else:
+		ns = list(namespaces)
+		explicit_ns = False
+
+	if not arg:
+		arg = '?*'
+	# '*', '**' and '~*' are literal keywords, unless the namespace
+	# does not include keywords
+	if (explicit_ns and 'kw' not in ns) or arg not in ('*', '**', '~*'):
+		for schr in ('*', '?', '['):
+			if schr in arg:
+				arg = Pattern(arg)
+				break
+	return (sorted(ns), arg, modifier)
+
+
+def find(pfiles, queries):
+	""" Iterate over FlagOccurences matching the --find queries.
+		The index for a namespace is built when first needed,
+		and the results are yielded as they are found. """
+	indexes = {}
+	for q in queries:
+		ns, arg, modifier = parse_query(q, pfiles.files)
+		for k in ns:
+			if k not in indexes:
+				indexes[k] = ReverseIndex(k, pfiles[k])
+			for o in indexes[k].lookup(arg, modifier):
+				yield o
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import os.path
+
+from portage import create_trees
+
+from flaggie.action import (Action, ActionSet, NotAnAction, OutputAction,
+		ParserError, ParserWarning)
+from flaggie.cache import Caches
+from flaggie.packagefile import PackageFiles
+
+
+class QueryResult(object):
+	def __init__(self, package, ns, flags):
+		self.package = package
+		self.ns = ns
+		# flag name -> '' (enabled), '-' (disabled) or None (not set)
+		self.flags = flags
+
+	def __repr__(self):
+		return 'QueryResult(%r, %r, %r)' % (self.package, self.ns, self.flags)
+
+
+class SessionResult(object):
+	def __init__(self):
+		self.warnings = []
+		self.queries = []
+
+
+class Session(object):
+	""" An in-process flaggie instance. The portage trees, metadata
+		caches and package.* files are kept between apply() calls,
+		and changes are written only on commit().
+
+		Example:
+
+			s = Session()
+			s.apply(['x11-libs/gtk+:2'], ['+doc', '-introspection'])
+			print(s.apply(['x11-libs/gtk+:2'], ['?doc']).queries)
+			s.commit()
+	"""
+
+	def __init__(self, config_root=None, target_root=None, dbapi=None,
+			stats=None, snapshot=None, sharded=False):
+		if dbapi is None:
+			trees = create_trees(config_root=config_root,
+					target_root=target_root)
+			dbapi = trees[max(trees)]['porttree'].dbapi
+		self.dbapi = dbapi
+		self.caches = Caches(dbapi, stats=stats, snapshot=snapshot)
+		self._sharded = sharded
+		self._pfiles = None
+
+	@property
+	def pfiles(self):
+		if self._pfiles is None:
+			confroot = self.dbapi.settings['PORTAGE_CONFIGROOT']
+			self._pfiles = PackageFiles(
+					os.path.join(confroot, 'etc', 'portage'), self.dbapi,
+					sharded=self._sharded)
+		return self._pfiles
+
+	def apply(self, packages, actions, strict=False):
+		""" Apply actions (e.g. '+doc', '-kw::~amd64', '?use::') to
+			packages. An empty packages list means global actions.
+			Raises ParserError on invalid input, and on warnings
+			if strict is True. Returns a SessionResult. """
+
+		res = SessionResult()
+		sink = []
+		actset = ActionSet(cache=self.caches)
+		for p in packages:
+			actset.append(self.caches.resolver.expand(p))
+		for a in actions:
+			if not a:
+				continue
+			try:
+				act = Action(a)
+			except NotAnAction:
+				raise ParserError('not an action: %s' % a)
+			if isinstance(act, OutputAction):
+				act.sink = sink
+			try:
+				actset.append(act)
+			except ParserWarning as e:
+				if strict:
+					raise ParserError(str(e))
+				res.warnings.append(str(e))
+
+		actset(self.pfiles)
+		for p, ns, flags in sink:
+			res.queries.append(QueryResult(p, ns, dict(
+				(k, v.modifier if v is not None else None)
+				for k, v in flags.items())))
+		return res
+
+	def commit(self):
+		""" Write all the modified package.* files. Raises
+			ConcurrentModification if another process modified one
+			of the files in the meantime; rollback() and apply
+			the changes again in that case. """
+		if self._pfiles is not None:
+			self._pfiles.write()
+			self._pfiles = None
+
+	def rollback(self):
+		""" Discard all changes not committed yet. """
+		self._pfiles = None
@@ -0,0 +1,360 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+# Compact, memory-mappable snapshot of repository metadata.
+#
+# The file consists of a fixed header followed by (in order):
+#
+# - the source description (srclen bytes, UTF-8 encoded): a line
+#   with the path and the metadata timestamp for every repository,
+#   used to reject snapshots of other or updated repositories,
+# - (nstrings + 1) uint32 offsets into the string blob,
+# - npkgs package records: cpv string id followed by (offset, count)
+#   into the id array for each namespace,
+# - ncps category/package records: cp string id, first package record
+#   and the number of package records (all versions of a cp are stored
+#   consecutively),
+# - nids uint32 string ids (sorted within every range),
+# - the string blob (sorted, UTF-8 encoded).
+#
+# All integers are little-endian. Since both the strings and the cps
+# are sorted, every lookup is a binary search over the mapped file.
+
+import bisect
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+from portage.dep import Atom, match_from_list
+from portage.exception import InvalidAtom
+from portage.versions import best
+
+NAMESPACES = ('use', 'kw', 'lic')
+MAGIC = b'FLAGSNP2'
+HEADER = struct.Struct('<8s6I%dI' % (2 * len(NAMESPACES)))
+UINT = struct.Struct('<I')
+PKG = struct.Struct('<%dI' % (1 + 2 * len(NAMESPACES)))
+CP = struct.Struct('<3I')
+
+
+class InvalidSnapshot(Exception):
+	pass
+
+
+def repo_timestamp(repo):
+	""" Return the timestamp of the metadata of repo: the newest mtime
+		of the sync timestamps and the md5-cache directories (which
+		change whenever a cache entry is replaced), or None. """
+	md5 = os.path.join(repo, 'metadata', 'md5-cache')
+	paths = [os.path.join(repo, 'metadata', x) for x in
+			('timestamp', 'timestamp.chk', 'timestamp.commit')]
+	paths.append(md5)
+	try:
+		paths.extend(os.path.join(md5, x) for x in os.listdir(md5))
+	except OSError:
+		pass
+
+	ret = None
+	for p in paths:
+		try:
+			mtime = os.stat(p).st_mtime
+		except OSError:
+			continue
+		if ret is None or mtime > ret:
+			ret = mtime
+	return ret
+
+
+def source_description(dbapi):
+	""" Describe the repositories of dbapi, for the snapshot header. """
+	return ''.join('%s\t%r\n' % (r, repo_timestamp(r))
+			for r in dbapi.porttrees)
+
+
+def compile_snapshot(path, dbapi, caches, jobs=None):
+	""" Compile a snapshot of all packages in dbapi to path. jobs
+		is the number of processes used to parse LICENSE strings. """
+	auxkeys = tuple(caches[ns].aux_key for ns in NAMESPACES)
+	auxs = []
+	for cp in dbapi.cp_all():
+		for cpv in dbapi.xmatch('match-all', cp):
+			auxs.append((cp, cpv, dbapi.aux_get(cpv, auxkeys)))
+
+	# LICENSE parsing is expensive, so do it in bulk
+	lic = NAMESPACES.index('lic')
+	caches['lic'].parse_bulk((aux[lic] for cp, cpv, aux in auxs), jobs)
+
+	pkgs = []
+	for cp, cpv, aux in auxs:
+		pkgs.append((cp, cpv, [frozenset(caches[ns]._aux_parse(v))
+			for ns, v in zip(NAMESPACES, aux)]))
+	globs = [caches[ns].glob for ns in NAMESPACES]
+
+	strings = set()
+	for cp, cpv, flags in pkgs:
+		strings.add(cp)
+		strings.add(cpv)
+		for fl in flags:
+			strings.update(fl)
+	for fl in globs:
+		strings.update(fl)
+	strings = sorted(strings)
+	sids = dict((s, i) for i, s in enumerate(strings))
+
+	ids = []
+
+	def add_ids(fl):
+		off = len(ids)
+		ids.extend(sorted(sids[x] for x in fl))
+		return (off, len(fl))
+
+	globrecs = []
+	for fl in globs:
+		globrecs.extend(add_ids(fl))
+
+	pkgs.sort(key=lambda x: (x[0], x[1]))
+	pkgrecs = []
+	cprecs = []
+	for i, (cp, cpv, flags) in enumerate(pkgs):
+		if not cprecs or cprecs[-1][0] != sids[cp]:
+			cprecs.append([sids[cp], i, 0])
+		cprecs[-1][2] += 1
+		rec = [sids[cpv]]
+		for fl in flags:
+			rec.extend(add_ids(fl))
+		pkgrecs.append(rec)
+
+	blob = []
+	offsets = [0]
+	for s in strings:
+		b = s.encode('utf8')
+		blob.append(b)
+		offsets.append(offsets[-1] + len(b))
+
+	src = source_description(dbapi).encode('utf8')
+	d = os.path.dirname(os.path.realpath(path))
+	f = tempfile.NamedTemporaryFile('wb', delete=False, dir=d)
+	try:
+		f.write(HEADER.pack(MAGIC, len(strings), offsets[-1],
+			len(pkgrecs), len(cprecs), len(ids), len(src), *globrecs))
+		f.write(src)
+		f.write(struct.pack('<%dI' % len(offsets), *offsets))
+		for rec in pkgrecs:
+			f.write(PKG.pack(*rec))
+		for rec in cprecs:
+			f.write(CP.pack(*rec))
+		f.write(struct.pack('<%dI' % len(ids), *ids))
+		f.write(b''.join(blob))
+		f.close()
+		os.chmod(f.name, 0o644)
+		os.rename(f.name, path)
+	except Exception:
+		f.close()
+		os.unlink(f.name)
+		raise
+
+
+class Snapshot(object):
+	def __init__(self, path):
+		self.path = path
+		f = open(path, 'rb')
+		try:
+			# mmap() refuses empty files
+			if os.fstat(f.fileno()).st_size == 0:
+				raise InvalidSnapshot('%s: empty file' % path)
+			self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+
+		try:
+			hdr = HEADER.unpack_from(self._mm, 0)
+		except struct.error:
+			raise InvalidSnapshot('%s: truncated header' % path)
+		if hdr[0] != MAGIC:
+			raise InvalidSnapshot('%s: not a flaggie snapshot' % path)
+		(self.nstrings, bloblen, self.npkgs, self.ncps,
+			nids, srclen) = hdr[1:7]
+		self._globs = dict((ns, hdr[7 + 2 * i:9 + 2 * i])
+				for i, ns in enumerate(NAMESPACES))
+
+		self._stroff = HEADER.size + srclen
+		try:
+			self.source = self._mm[HEADER.size:self._stroff].decode('utf8')
+		except UnicodeDecodeError:
+			raise InvalidSnapshot('%s: invalid source description' % path)
+		self._pkgoff = self._stroff + UINT.size * (self.nstrings + 1)
+		self._cpoff = self._pkgoff + PKG.size * self.npkgs
+		self._idoff = self._cpoff + CP.size * self.ncps
+		self._bloboff = self._idoff + UINT.size * nids
+		if self._bloboff + bloblen != len(self._mm):
+			raise InvalidSnapshot('%s: size mismatch' % path)
+
+	def check(self, dbapi):
+		""" Verify that the snapshot was compiled from the current
+			metadata of the repositories of dbapi. """
+		repos = [l.split('\t', 1)[0] for l in self.source.splitlines()]
+		if repos != list(dbapi.porttrees):
+			raise InvalidSnapshot('%s: compiled for different repositories (%s)'
+					% (self.path, ', '.join(repos)))
+		if self.source != source_description(dbapi):
+			raise InvalidSnapshot('%s: out of date, please recompile it'
+					% self.path)
+
+	def string(self, sid):
+		start, end = struct.unpack_from('<2I', self._mm,
+				self._stroff + UINT.size * sid)
+		return self._mm[self._bloboff + start:self._bloboff + end].decode('utf8')
+
+	def string_id(self, s):
+		""" Find the id of string s, or return None. """
+		b = s.encode('utf8')
+		lo, hi = 0, self.nstrings
+		while lo < hi:
+			mid = (lo + hi) // 2
+			start, end = struct.unpack_from('<2I', self._mm,
+					self._stroff + UINT.size * mid)
+			v = self._mm[self._bloboff + start:self._bloboff + end]
+			if v < b:
+				lo = mid + 1
+			elif v > b:
+				hi = mid
+			else:
+				return mid
+		return None
+
+	def id_at(self, idx):
+		return UINT.unpack_from(self._mm, self._idoff + UINT.size * idx)[0]
+
+	def packages(self, cp):
+		""" Return a list of (cpv, record index) for all versions of cp. """
+		sid = self.string_id(cp)
+		if sid is None:
+			return []
+		lo, hi = 0, self.ncps
+		while lo < hi:
+			mid = (lo + hi) // 2
+			cpid, first, count = CP.unpack_from(self._mm,
+					self._cpoff + CP.size * mid)
+			if cpid < sid:
+				lo = mid + 1
+			elif cpid > sid:
+				hi = mid
+			else:
+				return [(self.string(PKG.unpack_from(self._mm,
+					self._pkgoff + PKG.size * i)[0]), i)
+					for i in range(first, first + count)]
+		return []
+
+	def flags(self, ns, pkgidxs):
+		nsidx = NAMESPACES.index(ns)
+		ranges = []
+		for i in pkgidxs:
+			rec = PKG.unpack_from(self._mm, self._pkgoff + PKG.size * i)
+			ranges.append(rec[1 + 2 * nsidx:3 + 2 * nsidx])
+		return SnapshotFlags(self, ranges)
+
+	def glob(self, ns):
+		return SnapshotFlags(self, [self._globs[ns]])
+
+
+class SnapshotFlags(object):
+	""" A read-only set-like view over id ranges in the snapshot. """
+
+	class _Range(object):
+		def __init__(self, snap, off, count):
+			self._snap = snap
+			self._off = off
+			self._count = count
+
+		def __len__(self):
+			return self._count
+
+		def __getitem__(self, i):
+			return self._snap.id_at(self._off + i)
+
+	def __init__(self, snap, ranges):
+		self._snap = snap
+		self._ranges = [self._Range(snap, off, count)
+				for off, count in ranges]
+
+	def __contains__(self, s):
+		sid = self._snap.string_id(s)
+		if sid is None:
+			return False
+		for r in self._ranges:
+			i = bisect.bisect_left(r, sid)
+			if i < len(r) and r[i] == sid:
+				return True
+		return False
+
+	def __iter__(self):
+		seen = set()
+		for r in self._ranges:
+			for i in range(len(r)):
+				sid = r[i]
+				if sid not in seen:
+					seen.add(sid)
+					yield self._snap.string(sid)
+
+	def __len__(self):
+		return len(set(r[i] for r in self._ranges for i in range(len(r))))
+
+
+class SnapshotCache(object):
+	""" DBAPICache replacement answering queries from a Snapshot.
+		Atoms which can not be matched against the snapshot (i.e.
+		ones with slot, USE or repository restrictions) are passed
+		to the fallback cache. """
+
+	def __init__(self, snap, ns, fallback):
+		self._snap = snap
+		self._ns = ns
+		self._fallback = fallback
+
+	def __getattr__(self, k):
+		return getattr(self._fallback, k)
+
+	def _match(self, k):
+		try:
+			a = Atom(k)
+		except InvalidAtom:
+			return None
+		if a.slot or a.use or getattr(a, 'repo', None):
+			return None
+
+		pkgs = self._snap.packages(a.cp)
+		if a == a.cp:
+			return pkgs
+		m = set(match_from_list(a, [cpv for cpv, i in pkgs]))
+		return [(cpv, i) for cpv, i in pkgs if cpv in m]
+
+	@property
+	def glob(self):
+		return self._snap.glob(self._ns)
+
+	def prefetch(self, atoms, jobs=None):
+		""" Prefetch the atoms which need to be passed
+			to the fallback cache. """
+		prefetch = getattr(self._fallback, 'prefetch', None)
+		if prefetch is not None:
+			prefetch([k for k in atoms if self._match(k) is None], jobs)
+
+	def __getitem__(self, k):
+		pkgs = self._match(k)
+		if pkgs is None:
+			return self._fallback[k]
+		return self._snap.flags(self._ns, [i for cpv, i in pkgs])
+
+	def get_effective(self, k):
+		pkgs = self._match(k)
+		if pkgs is None:
+			return self._fallback.get_effective(k)
+		if not pkgs:
+			return frozenset()
+		bcpv = best([cpv for cpv, i in pkgs])
+		return self._snap.flags(self._ns,
+				[i for cpv, i in pkgs if cpv == bcpv])
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# vim:fileencoding=utf-8:noet
+# (C) 2017 Michał Górny <gentoo@mgorny.alt.pl>
+# Released under the terms of the 2-clause BSD license.
+
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class StatsCounter(object):
+	def __init__(self):
+		self.calls = 0
+		self.hits = 0
+		self.misses = 0
+		self.time = 0.0
+
+
+class Stats(object):
+	""" Counters for dbapi calls and cache lookups. """
+
+	def __init__(self):
+		self.counters = {}
+
+	def __getitem__(self, key):
+		if key not in self.counters:
+			self.counters[key] = StatsCounter()
+		return self.counters[key]
+
+	def call(self, key, elapsed=0.0):
+		c = self[key]
+		c.calls += 1
+		c.time += elapsed
+
+	def hit(self, key):
+		self[key].hits += 1
+
+	def miss(self, key, elapsed=0.0):
+		c = self[key]
+		c.misses += 1
+		c.time += elapsed
+
+	def report(self, output):
+		output.write('Statistics:\n')
+		if not self.counters:
+			output.write('\t(no calls recorded)\n')
+		for k in sorted(self.counters):
+			c = self.counters[k]
+			l = ['\t%-32s' % k]
+			if c.calls:
+				l.append('calls=%d' % c.calls)
+			if c.hits or c.misses:
+				l.append('hits=%d misses=%d (%.1f%% hit rate)'
+						% (c.hits, c.misses,
+							100.0 * c.hits / (c.hits + c.misses)))
+			l.append('time=%.3fs' % c.time)
+			output.write('%s\n' % ' '.join(l))
+
+
+class InstrumentedDBAPI(object):
+	""" A dbapi proxy counting and timing the calls done by flaggie. """
+
+	def __init__(self, dbapi, stats):
+		self._dbapi = dbapi
+		self._stats = stats
+
+	def __getattr__(self, k):
+		return getattr(self._dbapi, k)
+
+	def _timed(self, key, func, *args, **kwargs):
+		start = timer()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			self._stats.call(key, timer() - start)
+
+	def xmatch(self, level, origdep, *args, **kwargs):
+		return self._timed('dbapi.xmatch[%s]' % level,
+				self._dbapi.xmatch, level, origdep, *args, **kwargs)
+
+	def aux_get(self, mycpv, mylist, *args, **kwargs):
+		return self._timed('dbapi.aux_get[%s]' % ','.join(mylist),
+				self._dbapi.aux_get, mycpv, mylist, *args, **kwargs)
+
+	def cp_list(self, *args, **kwargs):
+		return self._timed('dbapi.cp_list',
+				self._dbapi.cp_list, *args, **kwargs)
+
+	def match(self, *args, **kwargs):
+		return self._timed('dbapi.match',
+				self._dbapi.match, *args, **kwargs)